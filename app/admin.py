@@ -7,11 +7,14 @@ from wtforms.validators import ValidationError
 
 from app.models import Class, Grade, User, Subject, UserRoleEnum, Score, Semester, \
     Schedule, Regulation, ScoreType, Profile, RegulationHistory
-from app import app, db, dao
+from app import app, db, dao, spreadsheet, perf, profiler, routing
 from flask_admin import Admin, BaseView, expose
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.ajax import QueryAjaxModelLoader, DEFAULT_PAGE_SIZE
 from flask_login import logout_user, current_user
-from flask import redirect, flash, request
+from flask import redirect, flash, request, Response, abort
+from sqlalchemy import inspect, or_
+from sqlalchemy.orm import selectinload, joinedload
 
 admin = Admin(app=app, name="QUẢN LÝ HỌC SINH", template_mode='bootstrap4')
 
@@ -26,6 +29,115 @@ class AuthenticatedUser(BaseView):
         return current_user.is_authenticated
 
 
+class AuthenticatedAdminView(BaseView):
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.user_role == UserRoleEnum.ADMIN
+
+
+class CountColumnsMixin:
+    # Cột số lượng thay cho cột quan hệ (vốn nạp toàn bộ bản ghi liên quan của mọi dòng).
+    # count_columns: {tên cột: hàm nhận danh sách id của trang, trả về {id: số lượng}},
+    # mỗi cột chỉ tốn một truy vấn GROUP BY cho cả trang.
+    count_columns = {}
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        count, data = super().get_list(page, sort_column, sort_desc, search, filters, execute=execute,
+                                       page_size=page_size)
+        if execute and data:
+            ids = [model.id for model in data]
+            for name, counter in self.count_columns.items():
+                counts = counter(ids)
+                for model in data:
+                    setattr(model, name, counts.get(model.id, 0))
+        return count, data
+
+
+class UserAjaxLoader(QueryAjaxModelLoader):
+    # Chọn người dùng bằng ô tìm kiếm phân trang thay vì một <select> chứa mọi tài khoản.
+    # Học sinh được tìm qua chỉ mục tên trong bộ nhớ của dao, giống ô tìm kiếm ở trang chủ;
+    # ILIKE chỉ chạy trên giáo viên và quản trị.
+    def __init__(self, name, role=None):
+        super().__init__(name, db.session, User, fields=['username'], page_size=10)
+        self.role = role
+
+    def get_query(self):
+        # format() hiển thị họ tên nên nạp hồ sơ cùng truy vấn, tránh một truy vấn cho mỗi dòng
+        query = super().get_query().options(joinedload(User.profile))
+        if self.role:
+            query = query.filter(User.user_role == self.role)
+        return query
+
+    def get_one(self, pk):
+        # Query.get() không dùng được trên truy vấn đã lọc theo vai trò
+        return self.get_query().filter(User.id == pk).one_or_none()
+
+    def get_list(self, term, offset=0, limit=DEFAULT_PAGE_SIZE):
+        # Flask-Admin truyền offset=None cho trang đầu
+        offset = offset or 0
+        query = self.get_query()
+        if term and self.role in (None, UserRoleEnum.STUDENT):
+            ids = dao.search_students(term)
+            if self.role is None:
+                # Không lọc vai trò: học sinh tìm qua chỉ mục, chỉ lọc ILIKE trên số ít giáo viên và quản trị
+                staff = self._filter_term(db.session.query(User.id), term) \
+                    .filter(User.user_role.in_([UserRoleEnum.ADMIN, UserRoleEnum.TEACHER]))
+                ids = sorted(ids + [user_id for user_id, in staff])
+            ids = ids[offset:offset + limit]
+            return query.filter(User.id.in_(ids)).order_by(User.id).all() if ids else []
+        if term:
+            query = self._filter_term(query, term)
+        return query.order_by(User.id).offset(offset).limit(limit).all()
+
+    @staticmethod
+    def _filter_term(query, term):
+        pattern = f'%{term}%'
+        return query.outerjoin(Profile, Profile.user_id == User.id).filter(
+            or_(User.username.ilike(pattern), Profile.firstname.ilike(pattern), Profile.lastname.ilike(pattern)))
+
+    def format(self, model):
+        if not model:
+            return None
+        name = f'{model.profile.firstname} {model.profile.lastname}' if model.profile else ''
+        return model.id, f'{model.username} - {name}' if name else model.username
+
+
+class SubjectAjaxLoader(QueryAjaxModelLoader):
+    # Tên môn lặp lại ở mỗi khối nên hiển thị kèm khối
+    def __init__(self, name):
+        super().__init__(name, db.session, Subject, fields=['name'], page_size=10)
+
+    def get_query(self):
+        return super().get_query().options(joinedload(Subject.grade))
+
+    def format(self, model):
+        if not model:
+            return None
+        return model.id, f'{model.name} - {model.grade}'
+
+
+class StreamingExportMixin:
+    # Xuất dữ liệu qua server-side cursor, đọc từng lô EXPORT_BATCH_SIZE dòng trong lúc gửi response
+    # thay vì nạp toàn bộ danh sách vào bộ nhớ
+    export_types = ['csv', 'xlsx']
+
+    def _export_data(self):
+        view_args = self._get_list_extra_args()
+        sort_column = self._get_column_by_idx(view_args.sort)
+        if sort_column is not None:
+            sort_column = sort_column[0]
+
+        count, query = self.get_list(0, sort_column, view_args.sort_desc, view_args.search, view_args.filters,
+                                     execute=False, page_size=self.export_max_rows)
+        return count, query.execution_options(stream_results=True).yield_per(app.config['EXPORT_BATCH_SIZE'])
+
+    def _export_tablib(self, export_type, return_url):
+        # xlsx ghi từng dòng bằng openpyxl thay vì dựng cả bảng bằng tablib
+        count, data = self._export_data()
+        header = [title for _, title in self._export_columns]
+        rows = ([self.get_export_value(model, name) for name, _ in self._export_columns] for model in data)
+        return spreadsheet.export_response(self.get_export_name(export_type), header, rows, export_type)
+
+
 class MyUserView(AuthenticatedAdmin):
     column_list = ['username', 'create_date', 'user_role', 'profile', 'status']
     form_base_class = SecureForm
@@ -51,8 +163,16 @@ class MyUserView(AuthenticatedAdmin):
             hashed_password = hashlib.md5(password.strip().encode('utf-8')).hexdigest()
             model.password = hashed_password
 
+    def after_model_change(self, form, model, is_created):
+        dao.clear_student_cache()
+        dao.invalidate_user(model.id)
+
+    def after_model_delete(self, model):
+        dao.clear_student_cache()
+        dao.invalidate_user(model.id)
+
 
-class MyProfileView(AuthenticatedAdmin):
+class MyProfileView(StreamingExportMixin, AuthenticatedAdmin):
     column_list = ['id', 'firstname', 'lastname', 'gender', 'dob', 'user_id']
     can_export = True
     can_create = True
@@ -72,26 +192,29 @@ class MyProfileView(AuthenticatedAdmin):
 
     column_filters = ['firstname', 'lastname']
     column_exclude_list = ['user_id']
+    form_ajax_refs = {
+        'user': UserAjaxLoader('user')
+    }
 
     def on_model_change(self, form, model, is_created):
         if is_created:
-            if is_created:
-                related_user = User.query.get(model.user_id)
-                if related_user is not None and related_user.user_role == UserRoleEnum.STUDENT:
-                    age = datetime.now().year - model.dob.year
-                    regulation = Regulation.query.first()
-                    if age < regulation.min_age or age > regulation.max_age:
-                        raise ValidationError(
-                            'Học sinh tiếp nhận phải có độ tuổi từ {} đến {}.'.format(regulation.min_age,
-                                                                                      regulation.max_age))
-
-                    num_students = User.query.filter_by(user_role=UserRoleEnum.STUDENT).count()
-                    max_students = Regulation.query.first().max_students
-                    if num_students >= max_students:
-                        # Nếu đã tiếp nhận đủ số lượng học sinh, thông báo lỗi
-                        raise ValidationError('Đã tiếp nhận đủ số lượng học sinh tối đa theo quy định.')
+            related_user = User.query.get(model.user_id)
+            if related_user is not None and related_user.user_role == UserRoleEnum.STUDENT:
+                # Kiểm tra độ tuổi và số lượng tiếp nhận với cùng một bản quy định
+                regulation = dao.get_current_regulation()
+                message = dao.check_admission_age(model.dob, regulation)
+                if message:
+                    raise ValidationError(message)
+
+                if dao.count_student(fresh=True) >= regulation.max_students:
+                    # Nếu đã tiếp nhận đủ số lượng học sinh, thông báo lỗi
+                    raise ValidationError('Đã tiếp nhận đủ số lượng học sinh tối đa theo quy định.')
 
     def after_model_change(self, form, model, is_created):
+        # Họ tên thay đổi thì chỉ mục tìm kiếm phải được dựng lại
+        dao.clear_student_cache()
+        if model.user_id:
+            dao.invalidate_user(model.user_id)
         if is_created:
             # Nếu không có user nào được gán vào profile, tạo tài khoản mới cho học sinh
             if model.user_id is None:
@@ -109,9 +232,15 @@ class MyProfileView(AuthenticatedAdmin):
                 # Nếu đã tiếp nhận đủ số lượng học sinh, tự động phân chia lớp
                 dao.assign_students_to_classes()
 
+    def after_model_delete(self, model):
+        dao.clear_student_cache()
+        if model.user_id:
+            dao.invalidate_user(model.user_id)
+
 
-class MyGradeView(AuthenticatedAdmin):
-    column_list = ['id', 'name', 'classes']
+class MyGradeView(CountColumnsMixin, AuthenticatedAdmin):
+    column_list = ['id', 'name', 'class_count']
+    count_columns = {'class_count': dao.count_classes_by_grade}
     can_create = True
     can_edit = True
     can_delete = True
@@ -120,15 +249,23 @@ class MyGradeView(AuthenticatedAdmin):
     column_labels = {
         'id': 'STT',
         'name': 'Khối',
-        'classes': 'Lớp học'
+        'classes': 'Lớp học',
+        'class_count': 'Số lớp'
     }
 
     form_excluded_columns = ['subjects']
     column_filters = ['name']
 
+    def after_model_change(self, form, model, is_created):
+        dao.clear_nav_cache()
+
+    def after_model_delete(self, model):
+        dao.clear_nav_cache()
+
 
-class MyClassView(AuthenticatedAdmin):
-    column_list = ['id', 'name', 'grade', 'quantity', 'users']
+class MyClassView(CountColumnsMixin, AuthenticatedAdmin):
+    column_list = ['id', 'name', 'grade', 'quantity', 'student_count']
+    count_columns = {'student_count': dao.count_students_by_class}
     can_create = True
     can_edit = True
     can_delete = True
@@ -139,12 +276,27 @@ class MyClassView(AuthenticatedAdmin):
         'name': 'Tên lớp',
         'grade': 'Khối',
         'quantity': 'Sĩ số',
-        'users': 'Học sinh'
+        'users': 'Học sinh',
+        'student_count': 'Số học sinh'
     }
 
     form_excluded_columns = ['schedules', 'quantity']
+    form_ajax_refs = {
+        'users': UserAjaxLoader('users', role=UserRoleEnum.STUDENT)
+    }
     column_filters = ['name', 'grade']
 
+    def get_one(self, id):
+        # Nạp sẵn học sinh kèm hồ sơ để ô chọn học sinh không truy vấn từng người
+        return self.session.query(Class).options(selectinload(Class.users).selectinload(User.profile)) \
+            .filter(Class.id == id).one_or_none()
+
+    def after_model_change(self, form, model, is_created):
+        dao.clear_nav_cache()
+
+    def after_model_delete(self, model):
+        dao.clear_nav_cache()
+
 
 class MySubjectView(AuthenticatedAdmin):
     column_list = ['id', 'name', 'grade']
@@ -162,6 +314,12 @@ class MySubjectView(AuthenticatedAdmin):
     form_excluded_columns = ['scores', 'schedules']
     column_filters = ['name', 'grade']
 
+    def after_model_change(self, form, model, is_created):
+        dao.clear_transcript_cache()
+
+    def after_model_delete(self, model):
+        dao.clear_transcript_cache()
+
 
 class MyScheduleView(AuthenticatedAdmin):
     can_create = True
@@ -178,6 +336,11 @@ class MyScheduleView(AuthenticatedAdmin):
     }
 
     column_filters = ['user', 'subject', 'class']
+    form_ajax_refs = {
+        'user': UserAjaxLoader('user', role=UserRoleEnum.TEACHER),
+        'subject': SubjectAjaxLoader('subject'),
+        'class': QueryAjaxModelLoader('class', db.session, Class, fields=['name'], page_size=10)
+    }
 
 
 class MyScoreView(AuthenticatedAdmin):
@@ -196,6 +359,26 @@ class MyScoreView(AuthenticatedAdmin):
     }
 
     column_filters = ['user', 'subject', 'semester', 'score', 'score_type']
+    form_ajax_refs = {
+        'user': UserAjaxLoader('user', role=UserRoleEnum.STUDENT),
+        'subject': SubjectAjaxLoader('subject')
+    }
+
+    def on_model_change(self, form, model, is_created):
+        # Ghi lại bộ khoá cũ để bảng tổng hợp được tính lại cả khi điểm bị chuyển sang học sinh/môn/học kì khác
+        if not is_created:
+            state = inspect(model)
+            model._old_summary_key = tuple((state.attrs[name].history.deleted or [getattr(model, name)])[0]
+                                           for name in ('user_id', 'subject_id', 'semester_id'))
+
+    def after_model_change(self, form, model, is_created):
+        keys = [(model.user_id, model.subject_id, model.semester_id)]
+        if getattr(model, '_old_summary_key', None):
+            keys.append(model._old_summary_key)
+        dao.scores_changed(keys)
+
+    def after_model_delete(self, model):
+        dao.scores_changed([(model.user_id, model.subject_id, model.semester_id)])
 
 
 class MyScoreTypeView(AuthenticatedAdmin):
@@ -212,6 +395,12 @@ class MyScoreTypeView(AuthenticatedAdmin):
     form_excluded_columns = ['scores']
     column_filters = ['name']
 
+    def after_model_change(self, form, model, is_created):
+        dao.clear_transcript_cache()
+
+    def after_model_delete(self, model):
+        dao.clear_transcript_cache()
+
 
 class MySemesterView(AuthenticatedAdmin):
     can_create = True
@@ -221,18 +410,26 @@ class MySemesterView(AuthenticatedAdmin):
 
     column_labels = {
         'name': 'Tên học kì',
-        'year': 'Năm học'
+        'year': 'Năm học',
+        'start_date': 'Ngày bắt đầu',
+        'end_date': 'Ngày kết thúc'
     }
 
     form_excluded_columns = ['scores']
     column_filters = ['name', 'year']
 
+    def after_model_change(self, form, model, is_created):
+        dao.clear_transcript_cache()
+
+    def after_model_delete(self, model):
+        dao.clear_transcript_cache()
+
 
 def remove_accents(input_str):
     return unidecode.unidecode(input_str)
 
 
-class MyRegulationView(AuthenticatedAdmin):
+class MyRegulationView(StreamingExportMixin, AuthenticatedAdmin):
     can_export = True
     can_create = True
     can_edit = True
@@ -250,12 +447,19 @@ class MyRegulationView(AuthenticatedAdmin):
     form_excluded_columns = ['user']
 
     def on_model_change(self, form, regulation, is_created):
-        # Khi một Regulation được tạo hoặc cập nhật, thêm một bản ghi vào RegulationHistory
-        history = RegulationHistory(admin_id=current_user.id, regulation_id=regulation.id, update_date=datetime.now())
+        # Khi một Regulation được tạo hoặc cập nhật, thêm một bản ghi vào RegulationHistory.
+        # Bản ghi mới làm tăng phiên bản quy định nên mọi worker nạp lại quy định ở request kế tiếp.
+        history = RegulationHistory(admin_id=current_user.id, regulation=regulation, update_date=datetime.now())
         db.session.add(history)
 
+    def after_model_change(self, form, regulation, is_created):
+        dao.clear_regulation_cache()
+
+    def after_model_delete(self, regulation):
+        dao.clear_regulation_cache()
+
 
-class MyRegulationHistoryView(AuthenticatedAdmin):
+class MyRegulationHistoryView(StreamingExportMixin, AuthenticatedAdmin):
     can_export = True
     can_create = True
     can_edit = True
@@ -286,6 +490,65 @@ class MyStatsView(AuthenticatedUser):
                            semesters=semesters)
 
 
+class MyPerfView(AuthenticatedAdminView):
+    @expose("/", methods=['GET', 'POST'])
+    def index(self):
+        if request.method == 'POST':
+            perf.reset()
+            return redirect(self.get_url('.index'))
+
+        return self.render('admin/perf.html', routes=perf.get_route_stats(), quantiles=perf.QUANTILES,
+                           budget=app.config['QUERY_BUDGET'], window=app.config['PERF_WINDOW'],
+                           pools=routing.get_pool_stats(db.engines))
+
+    @expose("/metrics")
+    def metrics(self):
+        return Response(perf.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
+class MyProfilerView(AuthenticatedAdminView):
+    @expose("/", methods=['GET', 'POST'])
+    def index(self):
+        if request.method == 'POST':
+            if request.form.get('action') == 'disarm':
+                profiler.disarm()
+            else:
+                try:
+                    profiler.arm(request.form.get('route', '').strip() or None,
+                                 user_id=int(request.form['user_id']) if request.form.get('user_id') else None,
+                                 count=int(request.form.get('count') or 1),
+                                 interval=float(request.form.get('interval') or 5) / 1000)
+                except ValueError:
+                    flash('Thông tin không hợp lệ.')
+            return redirect(self.get_url('.index'))
+
+        return self.render('admin/profiler.html', armed=profiler.get_armed(), profiles=profiler.list_profiles())
+
+    @expose("/<filename>")
+    def view(self, filename):
+        content = profiler.read_profile(filename)
+        if content is None:
+            abort(404)
+        return Response(content, mimetype='text/plain; charset=utf-8')
+
+
+class MyAdmissionView(AuthenticatedAdminView):
+    @expose("/", methods=['GET', 'POST'])
+    def index(self):
+        result = None
+        if request.method == 'POST':
+            file = request.files.get('file')
+            if not file:
+                flash('Chưa chọn file danh sách học sinh.')
+            else:
+                try:
+                    result = dao.admit_students(spreadsheet.read_rows(file))
+                except Exception as ex:
+                    flash('Lỗi ' + str(ex))
+
+        return self.render('admin/admission.html', result=result)
+
+
 class LogoutView(AuthenticatedUser):
     @expose("/")
     def index(self):
@@ -296,6 +559,7 @@ class LogoutView(AuthenticatedUser):
 # Quản lý người dùng
 admin.add_view(MyUserView(User, db.session, name='Quản lý tài khoản', category='Quản lý người dùng'))
 admin.add_view(MyProfileView(Profile, db.session, name='Quản lý thông tin', category='Quản lý người dùng'))
+admin.add_view(MyAdmissionView(name='Tiếp nhận học sinh', category='Quản lý người dùng'))
 
 # Quản lý học tập
 admin.add_view(MySemesterView(Semester, db.session, name='Quản lý học kì', category='Quản lý học tập'))
@@ -313,6 +577,8 @@ admin.add_view(
 
 # Thống kê và báo cáo
 admin.add_view(MyStatsView(name='Thống kê báo cáo'))
+admin.add_view(MyPerfView(name='Hiệu năng'))
+admin.add_view(MyProfilerView(name='Profiler'))
 
 # Đăng xuất
 admin.add_view(LogoutView(name='Đăng xuất'))
@@ -0,0 +1,103 @@
+import statistics
+import time
+
+from sqlalchemy import func
+
+from app import app, db, dao, seed
+from app.perf import count_queries
+from app.models import User, Class, Subject, Semester, Schedule, UserRoleEnum
+
+
+def clear_caches():
+    # Đo ở trạng thái chưa có cache để thấy chi phí thật của truy vấn
+    dao.clear_nav_cache()
+    dao.clear_student_cache()
+    dao.clear_regulation_cache()
+    dao.clear_transcript_cache()
+    db.session.remove()
+
+
+def _sample():
+    # Chọn một lớp, môn, học kì, học sinh và giáo viên có dữ liệu để đo
+    class_id, grade_id = db.session.query(Class.id, Class.grade_id).join(User, User.class_id == Class.id).first()
+    student_ids = [user_id for user_id, in db.session.query(User.id).filter(User.user_role == UserRoleEnum.STUDENT)
+                   .order_by(User.id.desc()).limit(app.config['PAGE_SIZE'] + 1)]
+    return {
+        "class_id": class_id,
+        "grade_id": grade_id,
+        "subject_id": db.session.query(Subject.id).filter(Subject.grade_id == grade_id).first()[0],
+        "semester_id": db.session.query(func.min(Semester.id)).scalar(),
+        "student_id": db.session.query(User.id).filter(User.class_id == class_id).first()[0],
+        "teacher_id": db.session.query(Schedule.user_id).first()[0],
+        # Con trỏ của trang cuối danh sách học sinh
+        "last_page_after": student_ids[-1],
+    }
+
+
+def _dao_cases(s):
+    return [
+        ("get_nav_tree", lambda: dao.get_nav_tree()),
+        ("get_students (trang đầu)", lambda: dao.get_students(None, None, page=1)),
+        ("get_students (trang cuối, keyset)", lambda: dao.get_students(None, None, after_id=s["last_page_after"])),
+        ("get_students (tìm kiếm)", lambda: dao.get_students('nguyen an', None, page=1)),
+        ("count_student", lambda: dao.count_student()),
+        ("get_students_by_class", lambda: dao.get_students_by_class(s["class_id"])),
+        ("get_teachers", lambda: dao.get_teachers()),
+        ("get_students_scores", lambda: dao.get_students_scores(s["class_id"], s["subject_id"], s["semester_id"])),
+        ("get_statistics", lambda: dao.get_statistics(s["subject_id"], s["semester_id"])),
+        ("get_scores_by_semester", lambda: dao.calculate_semester_averages(
+            dao.get_scores_by_semester(dao.get_scores(s["student_id"])))),
+        ("get_transcript", lambda: dao.get_transcript(s["student_id"])),
+        ("get_classes_and_subjects", lambda: dao.get_classes_and_subjects(s["teacher_id"], s["semester_id"])),
+        ("compute_semester_results (khối)", lambda: dao.compute_semester_results(s["semester_id"],
+                                                                                grade_id=s["grade_id"])),
+    ]
+
+
+def _measure(fn, repeat):
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        clear_caches()
+        with count_queries() as counter:
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        queries = counter["count"]
+    return round(statistics.median(timings) * 1000, 2), queries
+
+
+def bench_dao(repeat=3):
+    # Thời gian (trung vị, ms) và số truy vấn của từng hàm dao trên dữ liệu hiện có
+    s = _sample()
+    results = []
+    for name, fn in _dao_cases(s):
+        ms, queries = _measure(fn, repeat)
+        results.append({"name": name, "ms": ms, "queries": queries})
+
+    # Xếp lớp làm thay đổi dữ liệu nên chỉ chạy một lần, cho các học sinh chưa có lớp
+    ms, queries = _measure(dao.assign_students_to_classes, 1)
+    results.append({"name": "assign_students_to_classes", "ms": ms, "queries": queries})
+    return results
+
+
+def bench_scales(sizes=(1000, 10000, 100000), repeat=3):
+    # Sinh lại dữ liệu cho từng quy mô rồi đo; 1% học sinh được để chưa xếp lớp
+    report = {}
+    for size in sizes:
+        seed.generate_school(students=size, unassigned=max(size // 100, 1))
+        report[size] = bench_dao(repeat)
+    return report
+
+
+def bench_class_assignment(sizes=(10000, 100000), students=1000):
+    # Đo xếp lớp từ đầu tới cuối (đọc học sinh chưa có lớp, tạo lớp mới, UPDATE user theo lô) cho từng
+    # số học sinh mới tiếp nhận. Sinh lại dữ liệu cho từng quy mô: students học sinh đã có lớp và size học sinh chưa có lớp
+    results = []
+    for size in sizes:
+        seed.generate_school(students=students, unassigned=size)
+        classes = Class.query.count()
+        ms, queries = _measure(dao.assign_students_to_classes, 1)
+        results.append({"students": size, "classes": classes, "new_classes": Class.query.count() - classes,
+                        "ms": ms, "queries": queries})
+    return results
@@ -1,76 +1,296 @@
+import bisect
+import functools
+import heapq
+import inspect
+import math
 import random
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date
 
+from flask import g
 from flask_login import current_user
-from sqlalchemy import distinct, func, case, Float, Numeric
+from sqlalchemy import distinct, func, case, Float, Numeric, tuple_, insert, update, select, and_, or_
+from sqlalchemy.orm import selectinload, joinedload
 
 from app.models import Class, User, Grade, Schedule, Subject, Score, Semester, \
-    Regulation, UserRoleEnum, ScoreType
+    Regulation, UserRoleEnum, ScoreType, Profile, ScoreSummary, SemesterSummary, \
+    RegulationHistory
 from app import app, db
+from app.search import StudentSearchIndex, normalize
 import hashlib
 
 
+@contextmanager
+def _replica_reads(allowed=True):
+    info = db.session.info
+    previous = info.get('read_only', False)
+    info['read_only'] = allowed
+    try:
+        yield
+    finally:
+        info['read_only'] = previous
+
+
+def read_only(fn):
+    # Hàm chỉ đọc: truy vấn bên trong được chạy trên bản sao nếu có (xem routing.RoutingSession).
+    # Không dùng cho các hàm nạp dữ liệu vào cache được xoá khi ghi, vì bản sao có thể chưa kịp
+    # nhận thay đổi và cache sẽ giữ dữ liệu cũ.
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator(*args, **kwargs):
+            iterator = fn(*args, **kwargs)
+            while True:
+                with _replica_reads():
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+
+        return generator
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _replica_reads():
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+@read_only
 def get_classes():
     return Class.query.all()
 
 
+@read_only
 def get_class_by_id(class_id):
     return Class.query.get(class_id)
 
 
+@read_only
 def get_grades():
     return Grade.query.all()
 
 
+@read_only
 def get_subjects():
     return Subject.query.all()
 
 
+@read_only
 def get_score_type():
     return ScoreType.query.all()
 
 
+@read_only
 def get_teachers():
-    return User.query.filter_by(user_role=UserRoleEnum.TEACHER).all()
+    return User.query.options(joinedload(User.profile)).filter_by(user_role=UserRoleEnum.TEACHER).all()
 
 
 def get_user_by_id(user_id):
     return User.query.get(user_id)
 
 
+# Người dùng đã đăng nhập: {user_id: (thời điểm hết hạn, bản sao đã tách khỏi session)}.
+# Giữ tối đa USER_CACHE_SIZE người, bỏ người ít dùng nhất khi đầy.
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+
+def load_login_user(user_id):
+    user_id = int(user_id)
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry and entry[0] > now:
+            _user_cache.move_to_end(user_id)
+            user = entry[1]
+        else:
+            user = None
+
+    if user is None:
+        # Nạp người dùng cùng profile bằng một truy vấn rồi tách khỏi session để dùng lại ở các request sau
+        user = db.session.get(User, user_id, options=[joinedload(User.profile)])
+        if user is None:
+            return None
+        if user.profile is not None:
+            db.session.expunge(user.profile)
+        db.session.expunge(user)
+        with _user_cache_lock:
+            _user_cache[user_id] = (now + app.config['USER_CACHE_TTL'], user)
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > app.config['USER_CACHE_SIZE']:
+                _user_cache.popitem(last=False)
+
+    # Tài khoản bị khoá thì coi như chưa đăng nhập, chậm nhất sau USER_CACHE_TTL giây
+    if user.status is False:
+        return None
+
+    # Gắn một bản sao vào session của request hiện tại mà không cần truy vấn lại
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(int(user_id), None)
+
+
+@read_only
 def get_semester():
     return Semester.query.all()
 
 
+@read_only
 def get_classes_by_grade(grade_id):
     return Class.query.filter(Class.grade_id.__eq__(grade_id)).all()
 
 
+# Cây menu khối -> lớp dùng chung cho mọi trang: {'tree': (hết hạn, mã băm, cây), 'fragment': (mã băm, HTML)}.
+# Worker sửa khối/lớp xoá ngay; các worker khác nạp lại sau NAV_CACHE_TTL giây.
+_nav_cache = {}
+
+
+def _load_nav_tree():
+    now = time.monotonic()
+    entry = _nav_cache.get('tree')
+    if entry is None or entry[0] <= now:
+        grades = Grade.query.options(selectinload(Grade.classes)).order_by(Grade.id).all()
+        tree = [{
+            "id": g.id,
+            "name": g.name,
+            "classes": [{"id": c.id, "name": c.name} for c in sorted(g.classes, key=lambda c: c.id)]
+        } for g in grades]
+        # Mã băm theo nội dung: menu không đổi thì không phải render lại
+        entry = (now + app.config['NAV_CACHE_TTL'], hashlib.md5(repr(tree).encode('utf-8')).hexdigest(), tree)
+        _nav_cache['tree'] = entry
+    return entry
+
+
+def get_nav_tree():
+    return _load_nav_tree()[2]
+
+
+def get_nav_fragment(render):
+    # render nhận cây menu và trả về đoạn HTML đã render
+    _, digest, tree = _load_nav_tree()
+    entry = _nav_cache.get('fragment')
+    if entry is None or entry[0] != digest:
+        entry = (digest, render(tree))
+        _nav_cache['fragment'] = entry
+    return entry[1]
+
+
+def get_nav_version():
+    # Mã băm nội dung menu, giống nhau trên mọi worker và sau khi khởi động lại; dùng trong ETag
+    return _load_nav_tree()[1]
+
+
+def clear_nav_cache():
+    _nav_cache.clear()
+
+
+@read_only
 def get_students_by_class(class_id):
-    return User.query.filter_by(user_role=UserRoleEnum.STUDENT, class_id=class_id).all()
+    return User.query.options(joinedload(User.profile)).filter_by(user_role=UserRoleEnum.STUDENT,
+                                                                  class_id=class_id).all()
 
 
-def get_students(kw, class_id, page=None):
-    students = User.query.filter_by(user_role=UserRoleEnum.STUDENT)
+@read_only
+def get_students(kw, class_id, page=None, after_id=None):
+    # Nạp kèm profile và lớp trong cùng một truy vấn để tránh N+1 khi render danh sách
+    students = User.query.options(joinedload(User.profile), joinedload(getattr(User, 'class'))) \
+        .filter_by(user_role=UserRoleEnum.STUDENT)
+
+    page_size = app.config['PAGE_SIZE']
 
     if kw:
-        pass
+        # Tìm trên chỉ mục trong bộ nhớ rồi chỉ nạp đúng các học sinh của trang cần hiển thị
+        ids = search_students(kw, class_id)
+        if after_id:
+            start = bisect.bisect_right(ids, int(after_id))
+        elif page:
+            start = (int(page) - 1) * page_size
+        else:
+            start = 0
+        ids = ids[start:start + page_size]
+        return students.filter(User.id.in_(ids)).order_by(User.id).all() if ids else []
 
     if class_id:
         students = students.filter(User.class_id.__eq__(class_id))
 
+    students = students.order_by(User.id)
+
     if page:
         page = int(page)
-        page_size = app.config['PAGE_SIZE']
         start = (page - 1) * page_size
 
-        return students.slice(start, start + page_size)
+        return students.slice(start, start + page_size).all()
+
+    # Phân trang theo khoá (keyset): trang sau bắt đầu từ id lớn hơn id cuối của trang trước,
+    # nên trang sâu tốn chi phí như trang đầu. Không có after là trang đầu tiên.
+    if after_id:
+        students = students.filter(User.id > int(after_id))
+    return students.limit(page_size).all()
 
-    return students.all()
 
+# Sĩ số đã đếm theo từng lớp (None là toàn trường): {class_id: (hết hạn, số học sinh)}.
+# Worker thêm/xoá học sinh hoặc phân lớp lại xoá ngay; các worker khác đếm lại sau STUDENT_COUNT_TTL giây.
+_student_count_cache = {}
 
-def count_student():
-    return User.query.filter_by(user_role=UserRoleEnum.STUDENT).count()
+
+def count_student(class_id=None, fresh=False):
+    # fresh=True đếm lại từ cơ sở dữ liệu, dùng khi kiểm tra số lượng tiếp nhận tối đa
+    key = int(class_id) if class_id else None
+    now = time.monotonic()
+    entry = _student_count_cache.get(key)
+    if fresh or entry is None or entry[0] <= now:
+        students = User.query.filter_by(user_role=UserRoleEnum.STUDENT)
+        if key:
+            students = students.filter(User.class_id.__eq__(key))
+        entry = (now + app.config['STUDENT_COUNT_TTL'], students.count())
+        _student_count_cache[key] = entry
+    return entry[1]
+
+
+def _load_student_search_rows():
+    # Có thể được gọi bên trong get_students (read_only) nhưng chỉ mục bị xoá khi ghi nên luôn đọc từ primary
+    with _replica_reads(False):
+        return db.session.query(User.id, User.class_id, User.username, Profile.firstname, Profile.lastname) \
+            .outerjoin(Profile, Profile.user_id == User.id) \
+            .filter(User.user_role == UserRoleEnum.STUDENT).all()
+
+
+student_index = StudentSearchIndex(_load_student_search_rows, ttl=app.config['SEARCH_INDEX_TTL'])
+
+
+def search_students(kw, class_id=None):
+    return student_index.search(kw, class_id)
+
+
+def suggest_students(kw, limit=10):
+    return student_index.suggest(kw, limit)
+
+
+def count_students_by_class(class_ids):
+    # {class_id: số học sinh} cho nhiều lớp trong một truy vấn
+    return dict(db.session.query(User.class_id, func.count(User.id))
+                .filter(User.user_role == UserRoleEnum.STUDENT, User.class_id.in_(class_ids))
+                .group_by(User.class_id).all())
+
+
+def count_classes_by_grade(grade_ids):
+    return dict(db.session.query(Class.grade_id, func.count(Class.id))
+                .filter(Class.grade_id.in_(grade_ids)).group_by(Class.grade_id).all())
+
+
+def clear_student_cache():
+    _student_count_cache.clear()
+    _statistics_cache.clear()
+    _leaderboard_cache.clear()
+    student_index.invalidate()
 
 
 def auth_user(username, password):
@@ -89,16 +309,32 @@ def add_user(username, password, **kwargs):
 
     db.session.add(user)
     db.session.commit()
+    clear_student_cache()
+    return user
 
 
 def change_password(user, new_password):
     hashed_password = str(hashlib.md5(new_password.strip().encode('utf-8')).hexdigest())
     user.password = hashed_password
     db.session.commit()
+    invalidate_user(user.id)
+
+
+# Hệ số của từng loại điểm khi tính điểm trung bình môn
+SCORE_WEIGHTS = {"15 phút": 1, "1 tiết": 2, "Điểm thi": 3}
+
+# Số lần nhập tối đa của từng loại điểm trong một môn, một học kì
+SCORE_QUOTAS = {
+    "15 phút": (5, "Không thể nhập quá 5 lần điểm 15 phút."),
+    "1 tiết": (3, "Không thể nhập quá 3 lần điểm 1 tiết."),
+    "Điểm thi": (1, "Chỉ có thể nhập 1 lần điểm thi."),
+}
 
 
 def input_score(student_id, subject_id, type_id, score_value, semester_id):
-    # Kiểm tra xem điểm có nằm trong khoảng từ 0 tới 10 không
+    # Kiểm tra xem điểm có nằm trong khoảng từ 0 tới 10 không (nan, inf không phải là điểm)
+    if not math.isfinite(float(score_value)):
+        return "Điểm không hợp lệ."
     if float(score_value) < 0 or float(score_value) > 10:
         return "Điểm phải nằm trong khoảng từ 0 tới 10."
 
@@ -112,24 +348,229 @@ def input_score(student_id, subject_id, type_id, score_value, semester_id):
     # Kiểm tra số lượng điểm hiện tại
     existing_scores = Score.query.filter(Score.user_id == student_id, Score.subject_id == subject_id,
                                          Score.type_id == type_id, Score.semester_id == semester_id).count()
-    if score_type_name == '15 phút' and existing_scores >= 5:
-        return "Không thể nhập quá 5 lần điểm 15 phút."
-    elif score_type_name == '1 tiết' and existing_scores >= 3:
-        return "Không thể nhập quá 3 lần điểm 1 tiết."
-    elif score_type_name == 'Điểm thi' and existing_scores >= 1:
-        return "Chỉ có thể nhập 1 lần điểm thi."
+    quota = SCORE_QUOTAS.get(score_type_name)
+    if quota and existing_scores >= quota[0]:
+        return quota[1]
 
     # Tạo và lưu điểm mới
     new_score = Score(user_id=student_id, subject_id=subject_id, type_id=type_id, score=score_value,
                       semester_id=semester_id)
 
     db.session.add(new_score)
-    db.session.commit()
-
-
+    scores_changed([(int(student_id), int(subject_id), int(semester_id))])
+
+
+def _check_score(score_value, type_name, existing_scores):
+    # Kiểm tra một điểm theo thang 0-10 và số lần nhập tối đa của loại điểm, trả về thông báo lỗi nếu có
+    try:
+        score_value = float(score_value)
+    except (TypeError, ValueError):
+        return "Điểm không hợp lệ."
+    if not math.isfinite(score_value):
+        return "Điểm không hợp lệ."
+    if score_value < 0 or score_value > 10:
+        return "Điểm phải nằm trong khoảng từ 0 tới 10."
+    if type_name is None:
+        return "Loại điểm không tồn tại."
+    quota = SCORE_QUOTAS.get(type_name)
+    if quota and existing_scores >= quota[0]:
+        return quota[1]
+
+
+def _count_class_scores(student_ids, subject_id, semester_id):
+    # Số điểm hiện có theo (học sinh, loại điểm) của cả lớp, lấy bằng một truy vấn
+    rows = db.session.query(Score.user_id, Score.type_id, func.count(Score.id)).filter(
+        Score.user_id.in_(student_ids), Score.subject_id == subject_id, Score.semester_id == semester_id
+    ).group_by(Score.user_id, Score.type_id)
+    return {(user_id, type_id): count for user_id, type_id, count in rows}
+
+
+def _cell_id(value):
+    # Ô số trong XLSX có thể được đọc thành float (12.0), CSV luôn là chuỗi
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else None
+
+
+def import_scores(rows, class_id, subject_id, semester_id):
+    # rows là các dict đọc từ file (cột student_id hoặc username, type hoặc type_id, score).
+    # Kiểm tra toàn bộ trong bộ nhớ rồi ghi các dòng hợp lệ bằng một lệnh INSERT trong một giao dịch.
+    subject_id, semester_id = int(subject_id), int(semester_id)
+    students = dict(db.session.query(User.username, User.id).filter(User.user_role == UserRoleEnum.STUDENT,
+                                                                    User.class_id == class_id))
+    student_ids = set(students.values())
+    type_names = dict(db.session.query(ScoreType.id, ScoreType.name))
+    type_ids = {name: type_id for type_id, name in type_names.items()}
+    counts = _count_class_scores(student_ids, subject_id, semester_id)
+
+    new_scores = []
+    errors = []
+    # Dòng 1 là tiêu đề nên dữ liệu bắt đầu từ dòng 2
+    for line, row in enumerate(rows, start=2):
+        student_id = row.get('student_id')
+        if student_id:
+            student_id = _cell_id(student_id)
+        else:
+            student_id = students.get(str(row.get('username') or '').strip())
+        if student_id not in student_ids:
+            errors.append({"row": line, "message": "Học sinh không thuộc lớp này."})
+            continue
+
+        type_id = row.get('type_id')
+        if type_id:
+            type_id = _cell_id(type_id)
+        else:
+            type_id = type_ids.get(str(row.get('type') or '').strip())
+        type_name = type_names.get(type_id)
+
+        message = _check_score(row.get('score'), type_name, counts.get((student_id, type_id), 0))
+        if message:
+            errors.append({"row": line, "message": message})
+            continue
+
+        counts[(student_id, type_id)] = counts.get((student_id, type_id), 0) + 1
+        new_scores.append({"user_id": student_id, "subject_id": subject_id, "semester_id": semester_id,
+                           "type_id": type_id, "score": float(row['score'])})
+
+    if new_scores:
+        db.session.execute(insert(Score), new_scores)
+        scores_changed({(s["user_id"], subject_id, semester_id) for s in new_scores})
+
+    return {"inserted": len(new_scores), "errors": errors}
+
+
+def get_gradebook_columns():
+    # Mỗi loại điểm có số cột bằng số lần nhập tối đa của nó
+    return [{"id": t.id, "name": t.name, "slots": SCORE_QUOTAS.get(t.name, (1,))[0]}
+            for t in ScoreType.query.order_by(ScoreType.id)]
+
+
+def _gradebook_scores(student_ids, subject_id, semester_id):
+    # {học sinh: {loại điểm: [{"id", "score"}]}} cho một môn, một học kì
+    scores = {}
+    rows = db.session.query(Score.id, Score.user_id, Score.type_id, Score.score).filter(
+        Score.user_id.in_(student_ids), Score.subject_id == subject_id, Score.semester_id == semester_id
+    ).order_by(Score.id)
+    for score_id, user_id, type_id, score in rows:
+        scores.setdefault(user_id, {}).setdefault(type_id, []).append({"id": score_id, "score": score})
+    return scores
+
+
+def _gradebook_averages(student_ids, subject_id, semester_id):
+    return {s.user_id: {"average": s.average, "is_passing": s.is_passing}
+            for s in ScoreSummary.query.filter(ScoreSummary.user_id.in_(student_ids),
+                                               ScoreSummary.subject_id == subject_id,
+                                               ScoreSummary.semester_id == semester_id)}
+
+
+@read_only
+def get_gradebook(class_id, subject_id, semester_id):
+    students = get_students_by_class(class_id)
+    student_ids = [s.id for s in students]
+    scores = _gradebook_scores(student_ids, subject_id, semester_id)
+    averages = _gradebook_averages(student_ids, subject_id, semester_id)
+
+    return [{
+        "id": s.id,
+        "firstname": s.profile.firstname if s.profile else '',
+        "lastname": s.profile.lastname if s.profile else s.username,
+        "scores": scores.get(s.id, {}),
+        "average": averages.get(s.id, {}).get("average"),
+        "is_passing": averages.get(s.id, {}).get("is_passing", False)
+    } for s in students]
+
+
+def save_gradebook(changes, class_id, subject_id, semester_id):
+    # changes là các ô đã sửa: {"student_id", "type_id", "score_id" (ô đã có điểm), "score" ("" để xoá)}.
+    # Toàn bộ thay đổi được kiểm tra trước, chỉ ghi khi không có lỗi và ghi trong một giao dịch.
+    subject_id, semester_id = int(subject_id), int(semester_id)
+    student_ids = {user_id for user_id, in db.session.query(User.id).filter(User.user_role == UserRoleEnum.STUDENT,
+                                                                            User.class_id == class_id)}
+    type_names = dict(db.session.query(ScoreType.id, ScoreType.name))
+    existing = {score_id: (user_id, type_id) for score_id, user_id, type_id in db.session.query(
+        Score.id, Score.user_id, Score.type_id).filter(Score.user_id.in_(student_ids), Score.subject_id == subject_id,
+                                                      Score.semester_id == semester_id)}
+    counts = {}
+    for key in existing.values():
+        counts[key] = counts.get(key, 0) + 1
+
+    deleted, updated, inserted, errors = [], [], [], []
+    # Mỗi ô đã có điểm chỉ được sửa hoặc xoá một lần, nếu không số lần nhập bị trả lại nhiều lần
+    seen = set()
+    # Xử lý ô bị xoá trước để trả lại số lần nhập cho các ô thêm mới
+    for change in sorted(changes, key=lambda c: str(c.get('score', '')).strip() != ''):
+        try:
+            student_id, type_id = int(change.get('student_id')), int(change.get('type_id'))
+            score_id = int(change['score_id']) if change.get('score_id') else None
+        except (TypeError, ValueError):
+            errors.append({**change, "message": "Dữ liệu không hợp lệ."})
+            continue
+        value = str(change.get('score', '')).strip()
+
+        if student_id not in student_ids:
+            errors.append({**change, "message": "Học sinh không thuộc lớp này."})
+            continue
+        if score_id is not None and existing.get(score_id) != (student_id, type_id):
+            errors.append({**change, "message": "Điểm không tồn tại."})
+            continue
+        if score_id in seen:
+            errors.append({**change, "message": "Điểm bị sửa nhiều lần."})
+            continue
+        if score_id is not None:
+            seen.add(score_id)
+
+        if score_id is not None and value == '':
+            deleted.append(score_id)
+            counts[(student_id, type_id)] -= 1
+            continue
+        if value == '':
+            continue
+
+        # Sửa điểm đã có không làm tăng số lần nhập
+        used = counts.get((student_id, type_id), 0) - (1 if score_id is not None else 0)
+        message = _check_score(value, type_names.get(type_id), used)
+        if message:
+            errors.append({**change, "message": message})
+            continue
+
+        if score_id is not None:
+            updated.append({"id": score_id, "score": float(value)})
+        else:
+            counts[(student_id, type_id)] = counts.get((student_id, type_id), 0) + 1
+            inserted.append({"user_id": student_id, "subject_id": subject_id, "semester_id": semester_id,
+                             "type_id": type_id, "score": float(value)})
+
+    if errors:
+        return {"errors": errors}
+
+    if deleted:
+        Score.query.filter(Score.id.in_(deleted)).delete(synchronize_session=False)
+    if updated:
+        db.session.execute(update(Score), updated)
+    if inserted:
+        db.session.execute(insert(Score), inserted)
+
+    changed = {existing[score_id][0] for score_id in deleted} | \
+              {existing[s["id"]][0] for s in updated} | {s["user_id"] for s in inserted}
+    if changed:
+        scores_changed({(student_id, subject_id, semester_id) for student_id in changed})
+
+    # Trả lại điểm và điểm trung bình mới của các học sinh vừa sửa để cập nhật bảng mà không tải lại trang
+    scores = _gradebook_scores(changed, subject_id, semester_id)
+    averages = _gradebook_averages(changed, subject_id, semester_id)
+    return {"errors": [], "students": {student_id: {
+        "scores": scores.get(student_id, {}),
+        "average": averages.get(student_id, {}).get("average"),
+        "is_passing": averages.get(student_id, {}).get("is_passing", False)
+    } for student_id in changed}}
+
+
+@read_only
 def get_students_scores(class_id, subject_id, semester_id):
     # Lấy danh sách điểm số của sinh viên cho môn học cụ thể
-    scores = db.session.query(User, Score, ScoreType, Semester).join(
+    scores = db.session.query(User, Score, ScoreType, Semester).options(joinedload(User.profile)).join(
         Score, User.id == Score.user_id
     ).join(
         ScoreType, Score.type_id == ScoreType.id
@@ -163,15 +604,41 @@ def get_students_scores(class_id, subject_id, semester_id):
     # Chuyển từ điển thành danh sách để dễ dàng sử dụng trong template
     students_scores_list = list(students_scores.values())
 
-    # Tính điểm trung bình cho mỗi học sinh
+    # Điểm trung bình lấy từ bảng tổng hợp đã tính sẵn
+    summaries = {s.user_id: s for s in ScoreSummary.query.filter(ScoreSummary.user_id.in_(students_scores.keys()),
+                                                                 ScoreSummary.subject_id == subject_id,
+                                                                 ScoreSummary.semester_id == semester_id)}
     for score_dict in students_scores_list:
-        average_score = calculate_average_score(score_dict)
-        score_dict["average"] = average_score
-        score_dict["is_passing"] = is_student_passing(average_score)
+        summary = summaries.get(score_dict["id"])
+        score_dict["average"] = summary.average if summary else None
+        score_dict["is_passing"] = summary.is_passing if summary else False
 
     return students_scores_list
 
 
+SCORE_SHEET_HEADER = ['Lớp', 'Mã học sinh', 'Họ và tên đệm', 'Tên', 'Điểm 15 phút', 'Điểm 1 tiết', 'Điểm thi',
+                      'Điểm trung bình', 'Học kì', 'Kết quả']
+
+
+@read_only
+def iter_score_sheet(subject_id, semester_id, class_id=None):
+    # Bảng điểm một môn trong học kì của một lớp hoặc mọi lớp học môn đó.
+    # Lấy từng lớp qua get_students_scores nên bộ nhớ chỉ phụ thuộc sĩ số của một lớp.
+    classes = db.session.query(Class.id, Class.name)
+    if class_id:
+        classes = classes.filter(Class.id == class_id)
+    else:
+        classes = classes.join(Subject, Subject.grade_id == Class.grade_id).filter(Subject.id == subject_id)
+
+    for cls_id, class_name in classes.order_by(Class.id).all():
+        for s in get_students_scores(cls_id, subject_id, semester_id):
+            yield [class_name, s["id"], s["firstname"], s["lastname"],
+                   ', '.join(str(score) for score in s["15 phút"]),
+                   ', '.join(str(score) for score in s["1 tiết"]),
+                   ', '.join(str(score) for score in s["Điểm thi"]),
+                   s["average"], s["semester"], 'Đạt' if s["is_passing"] else 'Không đạt']
+
+
 def calculate_average_score(score_dict):
     total_score = 0
     total_coefficient = 0
@@ -189,29 +656,280 @@ def calculate_average_score(score_dict):
     return round(average_score, 2)
 
 
+def _summarize_scores(type_totals):
+    # type_totals: {tên loại điểm: (tổng điểm, số lượng)}, tính giống calculate_average_score
+    total_score = 0
+    total_coefficient = 0
+    for type_name, coefficient in SCORE_WEIGHTS.items():
+        type_sum, type_count = type_totals.get(type_name, (0, 0))
+        total_score += type_sum * coefficient
+        total_coefficient += type_count * coefficient
+
+    average_score = round(total_score / total_coefficient, 2) if total_coefficient else None
+    return total_score, total_coefficient, average_score
+
+
+def _score_type_totals(filters):
+    # Gom điểm theo (học sinh, môn, học kì, loại điểm) bằng một truy vấn
+    rows = db.session.query(Score.user_id, Score.subject_id, Score.semester_id, ScoreType.name,
+                            func.sum(Score.score), func.count(Score.id)) \
+        .join(ScoreType, Score.type_id == ScoreType.id).filter(*filters) \
+        .group_by(Score.user_id, Score.subject_id, Score.semester_id, ScoreType.name)
+
+    totals = {}
+    for user_id, subject_id, semester_id, type_name, type_sum, type_count in rows:
+        totals.setdefault((user_id, subject_id, semester_id), {})[type_name] = (type_sum, type_count)
+    return totals
+
+
+def _summary_row(key, type_totals):
+    weighted_sum, weight_total, average_score = _summarize_scores(type_totals)
+    return {"user_id": key[0], "subject_id": key[1], "semester_id": key[2],
+            "weighted_sum": weighted_sum, "weight_total": weight_total,
+            "average": average_score, "is_passing": is_student_passing(average_score)}
+
+
+def _semester_summary_rows(rows):
+    # Điểm trung bình học kì từ các dòng tổng hợp môn, cộng theo thứ tự môn như bảng điểm
+    subject_averages = {}
+    for row in sorted(rows, key=lambda r: (r["user_id"], r["semester_id"], r["subject_id"])):
+        subject_averages.setdefault((row["user_id"], row["semester_id"]), []).append(row["average"])
+    semester_rows = []
+    for (user_id, semester_id), averages in subject_averages.items():
+        average_score = semester_average(averages)
+        semester_rows.append({"user_id": user_id, "semester_id": semester_id, "average": average_score,
+                              "is_passing": is_student_passing(average_score)})
+    return semester_rows
+
+
+def _insert_summaries(totals):
+    rows = [_summary_row(key, type_totals) for key, type_totals in totals.items()]
+    if rows:
+        db.session.execute(ScoreSummary.__table__.insert(), rows)
+        db.session.execute(SemesterSummary.__table__.insert(), _semester_summary_rows(rows))
+    return len(rows)
+
+
+def refresh_score_summary(keys):
+    # Tính lại bảng tổng hợp cho các học sinh vừa thay đổi điểm. Điểm trung bình học kì cần mọi môn
+    # của học kì đó, nên tính lại cả các môn khác của (học sinh, học kì) bằng cùng một truy vấn.
+    pairs = {(user_id, semester_id) for user_id, _, semester_id in keys}
+    if not pairs:
+        return
+
+    totals = _score_type_totals([tuple_(Score.user_id, Score.semester_id).in_(pairs)])
+    ScoreSummary.query.filter(tuple_(ScoreSummary.user_id, ScoreSummary.semester_id).in_(pairs)) \
+        .delete(synchronize_session=False)
+    SemesterSummary.query.filter(tuple_(SemesterSummary.user_id, SemesterSummary.semester_id).in_(pairs)) \
+        .delete(synchronize_session=False)
+    _insert_summaries(totals)
+
+
+def rebuild_score_summary():
+    # Dựng lại toàn bộ bảng tổng hợp từ bảng Score (dùng khi cần khôi phục)
+    totals = _score_type_totals([])
+    ScoreSummary.query.delete(synchronize_session=False)
+    SemesterSummary.query.delete(synchronize_session=False)
+    count = _insert_summaries(totals)
+    db.session.commit()
+    _statistics_cache.clear()
+    _leaderboard_cache.clear()
+    return count
+
+
+def scores_changed(keys):
+    # Gọi sau mọi thao tác thêm/sửa/xoá điểm; keys là các bộ (user_id, subject_id, semester_id).
+    # id có thể là chuỗi lấy từ URL, đưa về số để khớp với khoá của các cache
+    keys = {(int(user_id), int(subject_id), int(semester_id)) for user_id, subject_id, semester_id in keys}
+    refresh_score_summary(keys)
+    db.session.commit()
+    for user_id, subject_id, semester_id in keys:
+        _statistics_cache.pop((subject_id, semester_id), None)
+    invalidate_transcripts({user_id for user_id, _, _ in keys})
+    invalidate_leaderboards(keys)
+
+
+def _teacher_schedules(query, teacher_id, semester):
+    # Lịch dạy của giáo viên có khoảng thời gian giao với học kì (dùng ix_schedule_user_dates).
+    # Lịch hoặc học kì chưa có ngày thì coi như không giới hạn ở đầu đó.
+    query = query.filter(Schedule.user_id == teacher_id)
+    if semester.end_date:
+        query = query.filter(or_(Schedule.start_date.is_(None),
+                                 Schedule.start_date <= datetime.combine(semester.end_date, datetime.max.time())))
+    if semester.start_date:
+        query = query.filter(or_(Schedule.end_date.is_(None),
+                                 Schedule.end_date >= datetime.combine(semester.start_date, datetime.min.time())))
+    return query
+
+
+@read_only
 def get_classes_and_subjects(teacher_id, semester_id):
-    # Truy vấn cơ sở dữ liệu để lấy danh sách các lớp và môn học mà giáo viên đang dạy trong học kỳ
-    classes_subjects = db.session.query(Schedule, Class, Subject).join(Class,
-                                                                       Schedule.class_id == Class.id).join(
-        Subject, Schedule.subject_id == Subject.id).filter(
-        Schedule.user_id == teacher_id).all()
+    # Các lớp và môn học mà giáo viên dạy trong học kì
+    semester = db.session.get(Semester, semester_id)
+    if semester is None:
+        return []
+
+    classes_subjects = _teacher_schedules(
+        db.session.query(Class.id, Class.name, Subject.id, Subject.name)
+        .select_from(Schedule)
+        .join(Class, Schedule.class_id == Class.id)
+        .join(Subject, Schedule.subject_id == Subject.id), teacher_id, semester) \
+        .order_by(Class.name, Subject.name).all()
+
+    counts = _missing_score_counts(teacher_id, semester)
 
     # Chuyển đổi kết quả truy vấn thành danh sách các từ điển
     classes_subjects_list = []
-    for record in classes_subjects:
+    for class_id, class_name, subject_id, subject_name in classes_subjects:
+        students, missing = counts.get((class_id, subject_id), (0, 0))
         classes_subjects_list.append({
-            "class_id": record.Class.id,
-            "class_name": record.Class.name,
-            "subject_id": record.Subject.id,
-            "subject_name": record.Subject.name,
-            "semester_id": semester_id
+            "class_id": class_id,
+            "class_name": class_name,
+            "subject_id": subject_id,
+            "subject_name": subject_name,
+            "semester_id": semester.id,
+            "students": students,
+            "missing_scores": missing
         })
 
     return classes_subjects_list
 
 
+def _missing_score_counts(teacher_id, semester):
+    # {(class_id, subject_id): (sĩ số, số học sinh còn thiếu ít nhất một loại điểm)} cho mọi lớp/môn
+    # giáo viên dạy trong học kì, tính bằng một truy vấn gộp
+    weighted_types = select(ScoreType.id).where(ScoreType.name.in_(SCORE_WEIGHTS.keys()))
+    per_student = _teacher_schedules(
+        db.session.query(User.class_id.label('class_id'), Schedule.subject_id.label('subject_id'),
+                         func.count(distinct(Score.type_id)).label('types'))
+        .select_from(User)
+        .join(Schedule, Schedule.class_id == User.class_id)
+        .outerjoin(Score, and_(Score.user_id == User.id,
+                               Score.subject_id == Schedule.subject_id,
+                               Score.semester_id == semester.id,
+                               Score.type_id.in_(weighted_types)))
+        .filter(User.user_role == UserRoleEnum.STUDENT), teacher_id, semester) \
+        .group_by(User.class_id, Schedule.subject_id, User.id).subquery()
+
+    rows = db.session.query(per_student.c.class_id, per_student.c.subject_id, func.count(),
+                            func.sum(case((per_student.c.types < len(SCORE_WEIGHTS), 1), else_=0))) \
+        .group_by(per_student.c.class_id, per_student.c.subject_id).all()
+    return {(class_id, subject_id): (students, int(missing or 0)) for class_id, subject_id, students, missing in rows}
+
+
+RegulationSnapshot = namedtuple('RegulationSnapshot', ['id', 'min_age', 'max_age', 'max_class_size', 'max_students'])
+
+# Bản quy định hiện hành kèm phiên bản; phiên bản đổi khi có bản ghi RegulationHistory mới
+_regulation_cache = {}
+
+
+def get_regulation_version():
+    # Mỗi lần sửa quy định trong trang quản trị đều ghi RegulationHistory, id lớn nhất của bảng này
+    # (cùng id quy định mới nhất) là phiên bản hiện tại
+    return tuple(db.session.query(
+        select(func.max(RegulationHistory.id)).scalar_subquery(),
+        select(func.max(Regulation.id)).scalar_subquery()
+    ).one())
+
+
+def sync_regulation_version():
+    # Gọi trong get_current_regulation, nhiều nhất một lần mỗi request (đánh dấu trong flask.g),
+    # nên worker nào cũng nhận quy định mới ngay ở request kế tiếp có dùng đến quy định
+    if g.get('regulation_synced'):
+        return
+    g.regulation_synced = True
+    version = get_regulation_version()
+    if _regulation_cache.get('version') != version:
+        _regulation_cache.clear()
+        _regulation_cache['version'] = version
+
+
+def clear_regulation_cache():
+    _regulation_cache.clear()
+
+
 def get_current_regulation():
-    return Regulation.query.order_by(Regulation.id.desc()).first()
+    sync_regulation_version()
+    if 'regulation' not in _regulation_cache:
+        r = Regulation.query.order_by(Regulation.id.desc()).first()
+        _regulation_cache['regulation'] = RegulationSnapshot(r.id, r.min_age, r.max_age, r.max_class_size,
+                                                             r.max_students) if r else None
+    return _regulation_cache['regulation']
+
+
+def check_admission_age(dob, regulation):
+    age = datetime.now().year - dob.year
+    if age < regulation.min_age or age > regulation.max_age:
+        return 'Học sinh tiếp nhận phải có độ tuổi từ {} đến {}.'.format(regulation.min_age, regulation.max_age)
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            pass
+
+
+def admit_students(rows):
+    # Tiếp nhận cả đợt học sinh từ file (cột firstname, lastname, gender, address, email, dob).
+    # Mọi dòng được kiểm tra với cùng một bản quy định, tài khoản và hồ sơ được ghi theo lô,
+    # cuối cùng chỉ xếp lớp một lần.
+    regulation = get_current_regulation()
+    remaining = regulation.max_students - count_student(fresh=True)
+
+    profiles = []
+    errors = []
+    # Dòng 1 là tiêu đề nên dữ liệu bắt đầu từ dòng 2
+    for line, row in enumerate(rows, start=2):
+        values = {key: str(row.get(key) or '').strip() for key in ('firstname', 'lastname', 'gender', 'address',
+                                                                   'email')}
+        if not all(values[key] for key in ('firstname', 'lastname', 'gender', 'address')):
+            errors.append({"row": line, "message": "Thiếu họ tên, giới tính hoặc địa chỉ."})
+            continue
+
+        dob = _parse_date(row.get('dob'))
+        if dob is None:
+            errors.append({"row": line, "message": "Ngày sinh không hợp lệ."})
+            continue
+
+        message = check_admission_age(dob, regulation)
+        if message:
+            errors.append({"row": line, "message": message})
+            continue
+
+        if len(profiles) >= remaining:
+            errors.append({"row": line, "message": "Đã tiếp nhận đủ số lượng học sinh tối đa theo quy định."})
+            continue
+
+        profiles.append({**values, "email": values['email'] or None, "dob": dob})
+
+    if not profiles:
+        return {"admitted": 0, "errors": errors}
+
+    # Tên tài khoản theo cùng quy tắc với trang quản trị: tên không dấu + số thứ tự hồ sơ
+    next_id = (db.session.query(func.max(Profile.id)).scalar() or 0) + 1
+    usernames = [normalize(f"{p['lastname']}{next_id + i}").replace(" ", "") for i, p in enumerate(profiles)]
+    taken = {username for username, in db.session.query(User.username).filter(User.username.in_(usernames))}
+    usernames = [f'{username}_{i}' if username in taken else username for i, username in enumerate(usernames)]
+
+    password = str(hashlib.md5('123456'.encode('utf-8')).hexdigest())
+    db.session.execute(insert(User), [{"username": username, "password": password,
+                                       "user_role": UserRoleEnum.STUDENT} for username in usernames])
+    user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames)))
+    db.session.execute(insert(Profile), [{**p, "user_id": user_ids[username]}
+                                         for p, username in zip(profiles, usernames)])
+
+    db.session.commit()
+    clear_student_cache()
+
+    # Xếp lớp một lần cho cả đợt
+    assign_students_to_classes()
+    return {"admitted": len(profiles), "errors": errors}
 
 
 def calculate_age(birth_date):
@@ -231,56 +949,119 @@ def is_student_passing(average_score):
     return average_score >= 5
 
 
+ClassStatistics = namedtuple('ClassStatistics', ['class_name', 'total_students', 'number_passed', 'pass_rate'])
+
+# Kết quả thống kê theo (subject_id, semester_id): (hết hạn, kết quả). Worker ghi điểm xoá ngay cặp đó,
+# các worker khác tính lại sau STATISTICS_CACHE_TTL giây.
+_statistics_cache = {}
+
+
 def get_statistics(subject_id, semester_id):
-    student_scores = db.session.query(
-        User.id.label('user_id'),
-        ((func.sum(case((ScoreType.name == '15 phút', Score.score), else_=0))
-          + 2 * func.sum(case((ScoreType.name == '1 tiết', Score.score), else_=0))
-          + 3 * func.sum(case((ScoreType.name == 'Điểm thi', Score.score), else_=0)))
-         / (func.sum(case((ScoreType.name == '15 phút', 1), else_=0))
-            + 2 * func.sum(case((ScoreType.name == '1 tiết', 1), else_=0))
-            + 3 * func.sum(case((ScoreType.name == 'Điểm thi', 1), else_=0)))).label('average_score')
-    ).join(Score).join(ScoreType, Score.type_id == ScoreType.id).filter(
-        Score.subject_id == subject_id, Score.semester_id == semester_id).group_by(User.id).subquery()
-
-    average_scores_query = db.session.query(student_scores).select_from(student_scores)
-    for row in average_scores_query:
-        print(f'user_id: {row.user_id}, average_score: {row.average_score}')
-
-    return db.session.query(
+    # Chưa chọn môn hoặc học kì thì không có gì để thống kê
+    try:
+        key = (int(subject_id), int(semester_id))
+    except (TypeError, ValueError):
+        return []
+
+    now = time.monotonic()
+    entry = _statistics_cache.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    number_passed = func.sum(case((ScoreSummary.is_passing, 1), else_=0))
+    rows = db.session.query(
         Class.name.label('class_name'),
         func.count(User.id).label('total_students'),
-        func.sum(case((student_scores.c.average_score >= 5, 1), else_=0)).label('number_passed'),
-    ).join(User).join(student_scores, User.id == student_scores.c.user_id).group_by(Class.name).add_columns(
-        (func.sum(case((student_scores.c.average_score >= 5, 1), else_=0)) / func.cast(func.count(User.id),
-                                                                                       Float) * 100).label('pass_rate'))
+        number_passed.label('number_passed'),
+    ).select_from(Class).join(User, User.class_id == Class.id).join(
+        ScoreSummary, User.id == ScoreSummary.user_id
+    ).filter(
+        ScoreSummary.subject_id == key[0], ScoreSummary.semester_id == key[1]
+    ).group_by(Class.name).add_columns((number_passed / func.cast(func.count(User.id), Float) * 100).label('pass_rate'))
+
+    # Chạy truy vấn đúng một lần, template duyệt lại danh sách bao nhiêu lần cũng được
+    statistics = [ClassStatistics(r.class_name, r.total_students, r.number_passed, r.pass_rate) for r in rows]
+    _statistics_cache[key] = (now + app.config['STATISTICS_CACHE_TTL'], statistics)
+    return statistics
+
+
+def plan_class_assignment(student_ids, class_sizes, max_class_size):
+    # class_sizes: {class_id: sĩ số hiện tại}. Trả về ({student_id: class_id hoặc số thứ tự lớp mới}, số lớp mới).
+    # Luôn lấy lớp ít học sinh nhất từ hàng đợi ưu tiên nên mỗi học sinh chỉ tốn O(log số lớp).
+    capacity = sum(max(max_class_size - quantity, 0) for quantity in class_sizes.values())
+    new_count = max(math.ceil((len(student_ids) - capacity) / max_class_size), 0)
+
+    heap = [(quantity, order, class_id) for order, (class_id, quantity) in enumerate(class_sizes.items())
+            if quantity < max_class_size]
+    # Lớp mới được đánh dấu bằng ('new', i) cho tới khi có id
+    heap += [(0, len(class_sizes) + i, ('new', i)) for i in range(new_count)]
+    heapq.heapify(heap)
 
+    assignment = {}
+    for student_id in student_ids:
+        quantity, order, class_id = heapq.heappop(heap)
+        assignment[student_id] = class_id
+        if quantity + 1 < max_class_size:
+            heapq.heappush(heap, (quantity + 1, order, class_id))
+    return assignment, new_count
+
+
+def _class_name_prefix(grade):
+    # "Khối 10" -> "10"
+    digits = ''.join(ch for ch in grade.name if ch.isdigit())
+    return digits or str(grade.id)
+
+
+def assign_students_to_classes(grade_id=None):
+    # Học sinh mới tiếp nhận được xếp vào các lớp của khối đầu tiên nếu không chỉ định khối
+    grade = Grade.query.get(grade_id) if grade_id else Grade.query.order_by(Grade.id).first()
+    if grade is None:
+        return
 
-def assign_students_to_classes():
     # Lấy danh sách tất cả học sinh chưa có lớp
-    students = User.query.filter_by(user_role=UserRoleEnum.STUDENT, class_id=None).all()
-    # Lấy max_class_size từ Regulation
-    max_class_size = Regulation.query.first().max_class_size
-    # Lấy danh sách tất cả lớp
-    classes = Class.query.all()
+    student_ids = [user_id for user_id, in db.session.query(User.id).filter(User.user_role == UserRoleEnum.STUDENT,
+                                                                            User.class_id.is_(None))]
+    if not student_ids:
+        return
+    max_class_size = get_current_regulation().max_class_size
+    classes = Class.query.filter(Class.grade_id == grade.id).order_by(Class.id).all()
     # Xáo trộn danh sách học sinh
-    random.shuffle(students)
-    # Phân chia học sinh vào các lớp
-    for student in students:
-        # Tìm lớp hiện tại có ít học sinh nhất và chưa đạt max_class_size
-        min_class = min([c for c in classes if c.quantity < max_class_size], key=lambda x: x.quantity, default=None)
-        if min_class is None:
-            # Nếu không tìm thấy lớp nào, tạo một lớp mới
-            new_class = Class(name=f'10A{len(classes) + 1}', quantity=0, grade_id=1)
-            db.session.add(new_class)
-            db.session.commit()
-            classes.append(new_class)
-            min_class = new_class
-        student.class_id = min_class.id
-        min_class.quantity += 1
+    random.shuffle(student_ids)
+
+    assignment, new_count = plan_class_assignment(student_ids, {c.id: c.quantity or 0 for c in classes},
+                                                  max_class_size)
+
+    # Tạo tất cả lớp mới bằng một lệnh INSERT theo lô rồi đọc lại id bằng một truy vấn
+    # (flush từng đối tượng Class sẽ gửi một INSERT cho mỗi lớp để lấy id)
+    prefix = _class_name_prefix(grade)
+    new_names = [f'{prefix}A{len(classes) + i + 1}' for i in range(new_count)]
+    new_ids = {}
+    if new_names:
+        db.session.execute(insert(Class), [{"name": name, "quantity": 0, "grade_id": grade.id} for name in new_names])
+        new_ids = dict(db.session.query(Class.name, Class.id).filter(
+            Class.grade_id == grade.id, Class.name.in_(new_names), Class.id.notin_([c.id for c in classes])))
+
+    class_ids = {c.id: c.id for c in classes}
+    class_ids.update({('new', i): new_ids[name] for i, name in enumerate(new_names)})
+    current = {c.id: c.quantity or 0 for c in classes}
+    quantities = {}
+    updates = []
+    for student_id, key in assignment.items():
+        class_id = class_ids[key]
+        quantities[class_id] = quantities.get(class_id, current.get(class_id, 0)) + 1
+        updates.append({"id": student_id, "class_id": class_id})
+
+    # Cập nhật lớp cho tất cả học sinh và sĩ số các lớp bằng các lệnh UPDATE theo lô
+    db.session.execute(update(User), updates)
+    db.session.execute(update(Class), [{"id": class_id, "quantity": quantity}
+                                       for class_id, quantity in quantities.items()])
     db.session.commit()
+    if new_names:
+        clear_nav_cache()
+    clear_student_cache()
 
 
+@read_only
 def get_scores(user_id):
     return Score.query.filter_by(user_id=user_id).all()
 
@@ -298,17 +1079,264 @@ def get_scores_by_semester(scores):
     return scores_by_semester
 
 
+def semester_average(subject_averages):
+    # Trung bình cộng các môn đã có điểm trung bình, làm tròn 2 chữ số
+    total_score = 0
+    total_subjects = 0
+    for subject_average in subject_averages:
+        if subject_average is not None:
+            total_score += subject_average
+            total_subjects += 1
+    if total_subjects > 0:
+        return round(total_score / total_subjects, 2)
+
+
 def calculate_semester_averages(scores_by_semester):
     semester_averages = {}
     for semester, subjects in scores_by_semester.items():
-        total_score = 0
-        total_subjects = 0
         for subject, score_types in subjects.items():
-            subject_average = calculate_average_score(score_types)
-            scores_by_semester[semester][subject]['Điểm trung bình'] = subject_average
-            if subject_average is not None:
-                total_score += subject_average
-                total_subjects += 1
-        if total_subjects > 0:
-            semester_averages[semester] = round(total_score / total_subjects, 2)
+            scores_by_semester[semester][subject]['Điểm trung bình'] = calculate_average_score(score_types)
+        average_score = semester_average(s['Điểm trung bình'] for s in subjects.values())
+        if average_score is not None:
+            semester_averages[semester] = average_score
     return semester_averages
+
+
+def get_scores_version(user_id=None, class_id=None, subject_id=None, semester_id=None):
+    # Phiên bản rẻ của một phạm vi điểm: số dòng và thời điểm cập nhật gần nhất.
+    # Thêm hoặc sửa điểm làm đổi thời điểm cập nhật, xoá điểm làm đổi số dòng.
+    query = db.session.query(func.count(Score.id), func.max(Score.update_date))
+    if user_id:
+        query = query.filter(Score.user_id == user_id)
+    if class_id:
+        query = query.join(User, User.id == Score.user_id).filter(User.class_id == class_id)
+    if subject_id:
+        query = query.filter(Score.subject_id == subject_id)
+    if semester_id:
+        query = query.filter(Score.semester_id == semester_id)
+    count, updated = query.one()
+    return count, str(updated) if updated else None
+
+
+# Trang đã render theo ETag; ETag đã gồm phiên bản dữ liệu nên không cần xoá khi ghi
+_rendered_cache = OrderedDict()
+_rendered_cache_lock = threading.Lock()
+
+
+def get_rendered(key, render):
+    with _rendered_cache_lock:
+        body = _rendered_cache.get(key)
+        if body is not None:
+            _rendered_cache.move_to_end(key)
+            return body
+
+    body = render()
+    with _rendered_cache_lock:
+        _rendered_cache[key] = body
+        while len(_rendered_cache) > app.config['RENDER_CACHE_SIZE']:
+            _rendered_cache.popitem(last=False)
+    return body
+
+
+# Bảng điểm đã tính của từng học sinh: {user_id: (phiên bản điểm, (scores_by_semester, semester_averages))}.
+# Phiên bản lấy từ get_scores_version nên worker khác ghi điểm thì bản cũ không còn được dùng.
+# Giữ tối đa TRANSCRIPT_CACHE_SIZE học sinh.
+_transcript_cache = OrderedDict()
+_transcript_cache_lock = threading.Lock()
+
+
+def _transcript_rows(user_id):
+    # Một truy vấn duy nhất, chỉ lấy tên học kì, môn, loại điểm và điểm thay vì nạp từng quan hệ lazy
+    return db.session.query(Semester.name, Subject.name, ScoreType.name, Score.score) \
+        .join(Semester, Score.semester_id == Semester.id) \
+        .join(Subject, Score.subject_id == Subject.id) \
+        .join(ScoreType, Score.type_id == ScoreType.id) \
+        .filter(Score.user_id == user_id) \
+        .order_by(Semester.id, Subject.id, ScoreType.id, Score.id).all()
+
+
+def _transcript_averages(user_id):
+    # Điểm trung bình học kì đã lưu, cùng giá trị với kết quả học kì và bảng xếp hạng
+    return db.session.query(Semester.name, SemesterSummary.average) \
+        .join(Semester, SemesterSummary.semester_id == Semester.id) \
+        .filter(SemesterSummary.user_id == user_id, SemesterSummary.average.isnot(None)) \
+        .order_by(Semester.id).all()
+
+
+def build_transcript(rows, averages=None):
+    # rows: các bộ (học kì, môn, loại điểm, điểm); kết quả giống get_scores_by_semester + calculate_semester_averages.
+    # averages: các bộ (học kì, điểm trung bình) đã lưu ở semester_summary, thay cho điểm tính lại từ rows
+    scores_by_semester = {}
+    for semester, subject, score_type, score in rows:
+        scores_by_semester.setdefault(semester, {}).setdefault(subject, {}).setdefault(score_type, []).append(score)
+    semester_averages = calculate_semester_averages(scores_by_semester)
+    if averages is not None:
+        # Tên học kì trùng giữa các năm thì bảng điểm đang gộp điểm các năm, giữ điểm tính lại từ rows
+        stored = {}
+        for semester, average_score in averages:
+            stored.setdefault(semester, []).append(average_score)
+        semester_averages.update({semester: values[0] for semester, values in stored.items() if len(values) == 1})
+    return scores_by_semester, semester_averages
+
+
+def get_transcript(user_id, version=None):
+    # version: get_scores_version(user_id=...) nếu nơi gọi đã tính (ví dụ để làm ETag)
+    user_id = int(user_id)
+    if version is None:
+        version = get_scores_version(user_id=user_id)
+    with _transcript_cache_lock:
+        entry = _transcript_cache.get(user_id)
+        if entry is not None and entry[0] == version:
+            _transcript_cache.move_to_end(user_id)
+            return entry[1]
+
+    transcript = build_transcript(_transcript_rows(user_id), _transcript_averages(user_id))
+    with _transcript_cache_lock:
+        _transcript_cache[user_id] = (version, transcript)
+        _transcript_cache.move_to_end(user_id)
+        while len(_transcript_cache) > app.config['TRANSCRIPT_CACHE_SIZE']:
+            _transcript_cache.popitem(last=False)
+    return transcript
+
+
+def invalidate_transcripts(user_ids):
+    with _transcript_cache_lock:
+        for user_id in user_ids:
+            _transcript_cache.pop(int(user_id), None)
+
+
+def clear_transcript_cache():
+    # Gọi khi đổi tên học kì, môn học hoặc loại điểm
+    with _transcript_cache_lock:
+        _transcript_cache.clear()
+
+
+@read_only
+def compute_semester_results(semester_id, class_id=None, grade_id=None):
+    # Tính kết quả cả học kì cho một lớp, một khối hoặc toàn trường trong một lượt:
+    # điểm trung bình từng môn, điểm trung bình học kì, kết quả đạt và thứ hạng.
+    semester_id = int(semester_id)
+    students = db.session.query(User.id, User.class_id).filter(User.user_role == UserRoleEnum.STUDENT)
+    if class_id:
+        students = students.filter(User.class_id == class_id)
+    if grade_id:
+        students = students.join(Class, User.class_id == Class.id).filter(Class.grade_id == grade_id)
+    student_classes = dict(students)
+
+    # Điểm đã gom theo (học sinh, môn, loại điểm) ở cơ sở dữ liệu, Python chỉ duyệt các tổng
+    filters = [Score.semester_id == semester_id]
+    if class_id or grade_id:
+        filters.append(Score.user_id.in_(students.with_entities(User.id)))
+    totals = _score_type_totals(filters)
+
+    # Điểm trung bình học kì đọc từ semester_summary, cùng cột với bảng xếp hạng và bảng điểm
+    gpas = db.session.query(SemesterSummary.user_id, SemesterSummary.average) \
+        .filter(SemesterSummary.semester_id == semester_id, SemesterSummary.average.isnot(None))
+    if class_id or grade_id:
+        gpas = gpas.filter(SemesterSummary.user_id.in_(students.with_entities(User.id)))
+    gpas = dict(gpas.all())
+
+    results = {}
+    for user_id, subject_id, _ in sorted(totals):
+        average_score = _summarize_scores(totals[(user_id, subject_id, semester_id)])[2]
+        result = results.get(user_id)
+        if result is None:
+            gpa = gpas.get(user_id)
+            result = results[user_id] = {"user_id": user_id, "class_id": student_classes.get(user_id),
+                                         "subjects": {}, "gpa": gpa, "is_passing": is_student_passing(gpa)}
+        result["subjects"][subject_id] = {"average": average_score, "is_passing": is_student_passing(average_score)}
+
+    # Xếp hạng kiểu thi đấu (1, 2, 2, 4) theo điểm trung bình học kì, toàn phạm vi và trong từng lớp
+    ranked = sorted((r for r in results.values() if r["gpa"] is not None), key=lambda r: -r["gpa"])
+    class_positions = {}
+    for position, result in enumerate(ranked, start=1):
+        previous = ranked[position - 2] if position > 1 else None
+        result["rank"] = previous["rank"] if previous and previous["gpa"] == result["gpa"] else position
+
+        last = class_positions.get(result["class_id"])
+        class_position = last[0] + 1 if last else 1
+        result["class_rank"] = last[1] if last and last[2] == result["gpa"] else class_position
+        class_positions[result["class_id"]] = (class_position, result["class_rank"], result["gpa"])
+
+    return sorted(results.values(), key=lambda r: (r["gpa"] is None, r.get("rank", 0), r["user_id"]))
+
+
+LEADERBOARD_SCOPES = ('class', 'grade', 'school')
+
+# Bảng xếp hạng đã tính: {(semester_id, subject_id hoặc None nếu là điểm TB học kì, phạm vi, id phạm vi):
+# (hết hạn, [dòng])}. Worker ghi điểm chỉ xoá các bảng của lớp, khối chứa học sinh đó và toàn trường;
+# các worker khác tính lại sau LEADERBOARD_CACHE_TTL giây.
+_leaderboard_cache = {}
+
+
+def _ranking_scores(semester_id, subject_id):
+    # Điểm dùng để xếp hạng: điểm trung bình môn (score_summary) hoặc điểm trung bình học kì đã lưu
+    # (semester_summary), nên xếp hạng, kết quả học kì và bảng điểm luôn cùng một điểm
+    summary = ScoreSummary if subject_id else SemesterSummary
+    query = db.session.query(summary.user_id.label('user_id'), summary.average.label('average')) \
+        .filter(summary.semester_id == semester_id, summary.average.isnot(None))
+    if subject_id:
+        query = query.filter(ScoreSummary.subject_id == subject_id)
+    return query.subquery()
+
+
+def _compute_leaderboard(semester_id, subject_id, scope, scope_id, limit):
+    scores = _ranking_scores(semester_id, subject_id)
+    partition = {'class': [User.class_id], 'grade': [Class.grade_id], 'school': None}[scope]
+    ranked = db.session.query(scores.c.user_id, scores.c.average, User.class_id, Class.name.label('class_name'),
+                              Profile.firstname, Profile.lastname,
+                              func.rank().over(partition_by=partition, order_by=scores.c.average.desc())
+                              .label('rank')) \
+        .join(User, User.id == scores.c.user_id) \
+        .join(Class, Class.id == User.class_id) \
+        .outerjoin(Profile, Profile.user_id == User.id)
+    if scope == 'class':
+        ranked = ranked.filter(User.class_id == scope_id)
+    elif scope == 'grade':
+        ranked = ranked.filter(Class.grade_id == scope_id)
+    ranked = ranked.subquery()
+
+    # Lọc theo thứ hạng sau khi đã xếp hạng, nên học sinh đồng hạng ở cuối bảng vẫn được giữ
+    rows = db.session.query(ranked)
+    if limit:
+        rows = rows.filter(ranked.c.rank <= limit)
+    return [{"user_id": r.user_id, "firstname": r.firstname, "lastname": r.lastname, "class_id": r.class_id,
+             "class_name": r.class_name, "average": r.average, "rank": r.rank}
+            for r in rows.order_by(ranked.c.rank, ranked.c.user_id)]
+
+
+def get_leaderboard(semester_id, scope='class', scope_id=None, subject_id=None):
+    # Xếp hạng kiểu thi đấu (1, 2, 2, 4) bằng RANK() OVER (PARTITION BY ...) trong cơ sở dữ liệu.
+    # Bảng của lớp giữ đủ học sinh, bảng khối và toàn trường giữ LEADERBOARD_SIZE hạng đầu.
+    if scope not in LEADERBOARD_SCOPES:
+        raise ValueError('Phạm vi xếp hạng không hợp lệ.')
+    semester_id = int(semester_id)
+    subject_id = int(subject_id) if subject_id else None
+    scope_id = int(scope_id) if scope != 'school' else None
+    key = (semester_id, subject_id, scope, scope_id)
+
+    now = time.monotonic()
+    entry = _leaderboard_cache.get(key)
+    if entry is None or entry[0] <= now:
+        limit = None if scope == 'class' else app.config['LEADERBOARD_SIZE']
+        entry = (now + app.config['LEADERBOARD_CACHE_TTL'],
+                 _compute_leaderboard(semester_id, subject_id, scope, scope_id, limit))
+        _leaderboard_cache[key] = entry
+    return entry[1]
+
+
+def invalidate_leaderboards(keys):
+    # keys là các bộ (user_id, subject_id, semester_id) vừa đổi điểm
+    if not _leaderboard_cache or not keys:
+        return
+    user_ids = {user_id for user_id, _, _ in keys}
+    placements = dict(((user_id, (class_id, grade_id)) for user_id, class_id, grade_id in
+                       db.session.query(User.id, User.class_id, Class.grade_id)
+                       .outerjoin(Class, Class.id == User.class_id).filter(User.id.in_(user_ids))))
+    for user_id, subject_id, semester_id in keys:
+        class_id, grade_id = placements.get(user_id, (None, None))
+        # Điểm môn đổi thì điểm trung bình học kì (subject None) cũng đổi
+        for subject in (subject_id, None):
+            _leaderboard_cache.pop((semester_id, subject, 'class', class_id), None)
+            _leaderboard_cache.pop((semester_id, subject, 'grade', grade_id), None)
+            _leaderboard_cache.pop((semester_id, subject, 'school', None), None)
@@ -1,30 +1,45 @@
 import hashlib
 import math
+import time
 
-from flask import render_template, request, redirect, url_for, flash
-import dao
-from app import app, login
+import click
+from flask import render_template, request, redirect, url_for, flash, jsonify, abort, Response, session
+from markupsafe import Markup
+from app import app, db, login, dao, spreadsheet, storage, perf, routing
+from app import profiler  # noqa: F401  đăng ký before_request/teardown_request của profiler
 from flask_login import login_user, logout_user, current_user, login_required
-import cloudinary.uploader
 
-from app.models import Class, UserRoleEnum, ScoreType, User, Semester
+from app.models import UserRoleEnum, ScoreType, User, Semester
 
 
 @app.route("/")
 def index():
     kw = request.args.get("kw")
-    class_id = request.args.get('class_id')
-    grade_id = request.args.get('grade_id')
-    page = request.args.get('page')
+    # id không phải số (ví dụ ?class_id=abc) được bỏ qua như khi không truyền
+    class_id = request.args.get('class_id', type=int)
+    grade_id = request.args.get('grade_id', type=int)
+    page = request.args.get('page', type=int)
+    if page is not None and page < 1:
+        page = None
+    after_id = request.args.get('after', type=int)
 
     grads = dao.get_grades()
     clas = dao.get_classes_by_grade(grade_id)
-    studs = dao.get_students(kw, class_id, page)
-    num = dao.count_student()
+    studs = dao.get_students(kw, class_id, page, after_id=after_id)
+    num = len(dao.search_students(kw, class_id)) if kw else dao.count_student(class_id)
     page_size = app.config['PAGE_SIZE']
+    # id của học sinh cuối trang, dùng làm con trỏ cho trang kế tiếp
+    next_after = studs[-1].id if len(studs) == page_size else None
 
     return render_template("index.html", classes=clas,
-                           students=studs, grades=grads, pages=math.ceil(num / page_size))
+                           students=studs, grades=grads, pages=math.ceil(num / page_size),
+                           next_after=next_after, class_id=class_id)
+
+
+@app.route("/api/students/search")
+def search_students():
+    kw = request.args.get("q", "")
+    return jsonify(dao.suggest_students(kw))
 
 
 @app.route("/about")
@@ -32,14 +47,38 @@ def about_page():
     return render_template("about.html")
 
 
+@app.before_request
+def stick_to_primary():
+    # Người dùng vừa ghi ở request trước thì đọc từ primary thêm REPLICA_STICKY_SECONDS giây
+    if session.get('primary_until', 0) > time.time():
+        db.session.info['sticky'] = True
+
+
+@app.after_request
+def remember_write(response):
+    # Chỉ gia hạn khi request này thật sự ghi (flush hoặc INSERT/UPDATE/DELETE), không gia hạn vì 'sticky'
+    if routing.REPLICA_BIND in app.config['SQLALCHEMY_BINDS'] and db.session.info.get('wrote'):
+        session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    # Cho Prometheus thu thập số liệu; tắt mặc định, bật bằng PERF_PROMETHEUS
+    if not app.config['PERF_PROMETHEUS']:
+        abort(404)
+    return Response(perf.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
 @app.context_processor
 def utility_functions():
-    def get_classes_by_grade(grade_id):
-        return Class.query.filter(Class.grade_id == grade_id).all()
+    def nav_menu():
+        # Đoạn menu khối/lớp chỉ render một lần, dùng lại cho tới khi admin sửa khối hoặc lớp
+        return Markup(dao.get_nav_fragment(
+            lambda tree: render_template('layout/nav_classes.html', nav_tree=tree)))
 
     return {
-        'grades': dao.get_grades(),
-        'get_classes_by_grade': get_classes_by_grade
+        'nav_menu': nav_menu
     }
 
 
@@ -98,22 +137,158 @@ def input_scores(class_id, subject_id, semester_id):
     return render_template('input_scores.html', students=students, semesters=semests, score_types=score_types)
 
 
+@app.route('/import_scores/<class_id>/<subject_id>/<semester_id>', methods=['POST'])
+def import_scores(class_id, subject_id, semester_id):
+    if not (current_user.is_authenticated and current_user.user_role == UserRoleEnum.TEACHER):
+        return jsonify({"error": "Bạn không có quyền nhập điểm."}), 403
+
+    file = request.files.get('file')
+    if not file:
+        return jsonify({"error": "Chưa chọn file điểm."}), 400
+
+    try:
+        rows = spreadsheet.read_rows(file)
+        result = dao.import_scores(rows, class_id=class_id, subject_id=subject_id, semester_id=semester_id)
+    except Exception as ex:
+        return jsonify({"error": 'Lỗi ' + str(ex)}), 400
+
+    return jsonify(result)
+
+
+@app.route('/gradebook/<class_id>/<subject_id>/<semester_id>', methods=['GET', 'POST'])
+def gradebook(class_id, subject_id, semester_id):
+    if not (current_user.is_authenticated and current_user.user_role == UserRoleEnum.TEACHER):
+        return redirect(url_for('user_login'))
+
+    if request.method == 'POST':
+        # Chỉ nhận các ô đã thay đổi, ghi cả lô trong một giao dịch
+        payload = request.get_json(silent=True)
+        changes = payload.get('changes', []) if isinstance(payload, dict) else None
+        if not isinstance(changes, list) or not all(isinstance(change, dict) for change in changes):
+            return jsonify({"errors": [{"message": "Dữ liệu không hợp lệ."}]}), 400
+        result = dao.save_gradebook(changes, class_id=class_id, subject_id=subject_id, semester_id=semester_id)
+        return jsonify(result), 400 if result['errors'] else 200
+
+    students = dao.get_gradebook(class_id, subject_id, semester_id)
+    columns = dao.get_gradebook_columns()
+    return render_template('gradebook.html', students=students, columns=columns)
+
+
+def conditional_response(scope, version, render, mimetype='text/html'):
+    # ETag gồm phạm vi dữ liệu, phiên bản điểm và người xem (header trang khác nhau theo người dùng).
+    # Trình duyệt gửi lại If-None-Match thì trả 304 mà không dựng lại dữ liệu; nếu không thì
+    # dùng lại nội dung đã render cho cùng ETag.
+    user = (current_user.id, current_user.avatar) if current_user.is_authenticated else None
+    etag = hashlib.md5(repr((scope, version, user, dao.get_nav_version())).encode('utf-8')).hexdigest()
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(dao.get_rendered(etag, render), mimetype=mimetype)
+    response.set_etag(etag)
+    # Chỉ trình duyệt của người dùng được lưu, và luôn hỏi lại máy chủ trước khi dùng
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _class_scores_version(class_id, subject_id, semester_id):
+    return dao.get_scores_version(class_id=class_id, subject_id=subject_id, semester_id=semester_id)
+
+
 @app.route('/view_scores/<class_id>/<subject_id>/<semester_id>', methods=['GET'])
 def view_scores(class_id, subject_id, semester_id):
-    students_scores = dao.get_students_scores(class_id, subject_id, semester_id=semester_id)
-    return render_template('view_scores.html', scores=students_scores)
+    return conditional_response(
+        ('view_scores', class_id, subject_id, semester_id), _class_scores_version(class_id, subject_id, semester_id),
+        lambda: render_template('view_scores.html',
+                                scores=dao.get_students_scores(class_id, subject_id, semester_id=semester_id)))
+
+
+@app.route('/api/view_scores/<class_id>/<subject_id>/<semester_id>', methods=['GET'])
+def view_scores_json(class_id, subject_id, semester_id):
+    return conditional_response(
+        ('view_scores.json', class_id, subject_id, semester_id),
+        _class_scores_version(class_id, subject_id, semester_id),
+        lambda: app.json.dumps(dao.get_students_scores(class_id, subject_id, semester_id=semester_id)),
+        mimetype='application/json')
+
+
+@app.route('/export_scores/<subject_id>/<semester_id>.<export_type>', methods=['GET'])
+def export_scores(subject_id, semester_id, export_type):
+    if not (current_user.is_authenticated and current_user.user_role in (UserRoleEnum.TEACHER, UserRoleEnum.ADMIN)):
+        return redirect(url_for('user_login'))
+    if export_type not in spreadsheet.EXPORT_MIMETYPES:
+        abort(404)
+
+    # Bỏ class_id để xuất mọi lớp học môn này
+    class_id = request.args.get('class_id')
+    rows = dao.iter_score_sheet(subject_id, semester_id, class_id=class_id)
+    filename = f'bang_diem_{class_id or "tat_ca"}_{subject_id}_{semester_id}.{export_type}'
+    return spreadsheet.export_response(filename, dao.SCORE_SHEET_HEADER, rows, export_type)
 
 
 @app.route('/student_scores', methods=['GET'])
 def student_scores():
-    if current_user.is_authenticated and current_user.user_role == UserRoleEnum.STUDENT:
-        scores = dao.get_scores(current_user.id)
-        scores_by_semester = dao.get_scores_by_semester(scores)
-        semester_averages = dao.calculate_semester_averages(scores_by_semester)
-    else:
+    if not (current_user.is_authenticated and current_user.user_role == UserRoleEnum.STUDENT):
         return redirect(url_for('user_login'))
-    return render_template('student_scores.html', scores_by_semester=scores_by_semester,
-                           semester_averages=semester_averages)
+
+    version = dao.get_scores_version(user_id=current_user.id)
+
+    def render():
+        scores_by_semester, semester_averages = dao.get_transcript(current_user.id, version)
+        return render_template('student_scores.html', scores_by_semester=scores_by_semester,
+                               semester_averages=semester_averages)
+
+    return conditional_response('student_scores', version, render)
+
+
+@app.route('/api/student_scores', methods=['GET'])
+def student_scores_json():
+    if not (current_user.is_authenticated and current_user.user_role == UserRoleEnum.STUDENT):
+        return jsonify({"error": "Bạn cần đăng nhập bằng tài khoản học sinh."}), 401
+
+    version = dao.get_scores_version(user_id=current_user.id)
+
+    def render():
+        scores_by_semester, semester_averages = dao.get_transcript(current_user.id, version)
+        return app.json.dumps({"scores_by_semester": scores_by_semester, "semester_averages": semester_averages})
+
+    return conditional_response('student_scores.json', version, render, mimetype='application/json')
+
+
+@app.route('/rankings', methods=['GET'])
+def rankings():
+    if not current_user.is_authenticated:
+        return redirect(url_for('user_login'))
+
+    semesters = dao.get_semester()
+    nav_tree = dao.get_nav_tree()
+    semester_id = request.args.get('semester_id') or (semesters[-1].id if semesters else None)
+    subject_id = request.args.get('subject_id') or None
+    scope = request.args.get('scope', 'class')
+    if scope not in dao.LEADERBOARD_SCOPES:
+        abort(404)
+
+    # Mặc định là lớp (khối) của học sinh đang đăng nhập, nếu không thì lớp (khối) đầu tiên
+    class_id = request.args.get('class_id') or current_user.class_id or next(
+        (c["id"] for g in nav_tree for c in g["classes"]), None)
+    grade_id = request.args.get('grade_id') or next(
+        (g["id"] for g in nav_tree if any(str(c["id"]) == str(class_id) for c in g["classes"])),
+        nav_tree[0]["id"] if nav_tree else None)
+    scope_id = {'class': class_id, 'grade': grade_id, 'school': None}[scope]
+
+    leaderboard = []
+    if semester_id and (scope == 'school' or scope_id):
+        try:
+            leaderboard = dao.get_leaderboard(semester_id, scope, scope_id, subject_id=subject_id)
+        except ValueError:
+            # id trên URL không phải là số
+            abort(404)
+
+    return render_template('rankings.html', leaderboard=leaderboard, semesters=semesters,
+                           subjects=dao.get_subjects(), nav_tree=nav_tree, scope=scope,
+                           selected={"semester_id": str(semester_id), "subject_id": str(subject_id or ''),
+                                     "class_id": str(class_id), "grade_id": str(grade_id)})
 
 
 @app.route("/teachers")
@@ -129,17 +304,13 @@ def user_register():
         username = request.form.get('username')
         password = request.form.get('password')
         confirm = request.form.get('confirm')
-        avatar_path = None
         try:
             if password.strip().__eq__(confirm.strip()):
                 avatar = request.files.get('avatar')
+                user = dao.add_user(username=username, password=password)
                 if avatar:
-                    res = cloudinary.uploader.upload(avatar)
-                    avatar_path = res['secure_url']
-                    print("Avatar path:", avatar_path)
-                else:
-                    print("Error")
-                dao.add_user(username=username, password=password, avatar=avatar_path)
+                    # Ảnh được tải lên ở luồng nền, User.avatar được cập nhật khi tải xong
+                    storage.submit_avatar(user.id, avatar.read())
                 return redirect(url_for('index'))
             else:
                 err_msg = 'Mật khẩu xác nhận không khớp!!'
@@ -185,7 +356,7 @@ def admin_login():
 
 @login.user_loader
 def load_user(user_id):
-    return dao.get_user_by_id(user_id)
+    return dao.load_login_user(user_id)
 
 
 @app.route("/change_password", methods=['GET', 'POST'])
@@ -213,6 +384,92 @@ def change_password():
     return render_template('change_password.html')
 
 
+@app.cli.command("rebuild-score-summary")
+def rebuild_score_summary():
+    # Dựng lại bảng tổng hợp điểm từ bảng Score: flask --app app.index rebuild-score-summary
+    count = dao.rebuild_score_summary()
+    print(f"Đã tổng hợp {count} dòng điểm.")
+
+
+@app.cli.command("semester-results")
+@click.argument("semester_id", type=int)
+@click.option("--class-id", type=int)
+@click.option("--grade-id", type=int)
+def semester_results(semester_id, class_id, grade_id):
+    # Xuất kết quả học kì dạng CSV: flask --app app.index semester-results 1 --grade-id 1
+    print("user_id,class_id,gpa,is_passing,rank,class_rank")
+    for r in dao.compute_semester_results(semester_id, class_id=class_id, grade_id=grade_id):
+        print(f"{r['user_id']},{r['class_id']},{r['gpa']},{r['is_passing']},{r.get('rank', '')},{r.get('class_rank', '')}")
+
+
+@app.cli.command("bench-assign")
+@click.option("--sizes", default="10000,100000", help="Số học sinh chưa có lớp của từng lần đo")
+@click.confirmation_option(prompt="Dữ liệu sẽ được sinh lại cho từng quy mô và xoá dữ liệu hiện có. Tiếp tục?")
+def bench_assign(sizes):
+    # Đo xếp lớp ở 10k và 100k học sinh: DATABASE_URL=sqlite:///bench.db flask --app app.index bench-assign --yes
+    from app import bench
+
+    for r in bench.bench_class_assignment([int(size) for size in sizes.split(",")]):
+        print(f"{r['students']} học sinh, {r['classes']} lớp có sẵn, {r['new_classes']} lớp mới: "
+              f"{r['ms']} ms, {r['queries']} truy vấn")
+
+
+@app.cli.command("seed")
+@click.option("--students", default=1000)
+@click.option("--grades", default=3)
+@click.option("--class-size", default=40)
+@click.option("--subjects", default=8)
+@click.option("--semesters", default=2)
+@click.option("--unassigned", default=0)
+@click.confirmation_option(prompt="Toàn bộ dữ liệu hiện có sẽ bị xoá. Tiếp tục?")
+def seed(**options):
+    # Sinh dữ liệu thử: DATABASE_URL=sqlite:///bench.db flask --app app.index seed --students 10000 --yes
+    from app import seed as generator
+
+    print(generator.generate_school(**options))
+
+
+@app.cli.command("bench")
+@click.option("--sizes", default="", help="Ví dụ 1000,10000,100000; bỏ trống để đo dữ liệu hiện có")
+@click.option("--repeat", default=3)
+def bench_command(sizes, repeat):
+    # Đo thời gian và số truy vấn của các hàm dao: flask --app app.index bench --sizes 1000,10000
+    from app import bench
+
+    if sizes:
+        click.confirm("Dữ liệu sẽ được sinh lại cho từng quy mô và xoá dữ liệu hiện có. Tiếp tục?", abort=True)
+        report = bench.bench_scales([int(size) for size in sizes.split(",")], repeat=repeat)
+    else:
+        report = {"hiện có": bench.bench_dao(repeat=repeat)}
+
+    for size, results in report.items():
+        print(f"== {size} học sinh ==")
+        for r in results:
+            print(f"{r['name']:<40} {r['ms']:>10} ms {r['queries']:>6} truy vấn")
+
+
+@app.cli.command("migrate")
+def migrate():
+    # Thêm bảng, cột và chỉ mục còn thiếu: flask --app app.index migrate
+    from app import migrate as migration
+
+    for name in migration.migrate():
+        print(f"Đã tạo {name}")
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans():
+    # Báo lỗi nếu truy vấn nào trong dao phải quét toàn bộ một bảng lớn
+    from app import migrate as migration
+
+    problems = migration.check_query_plans()
+    for name, scans in problems.items():
+        print(f"{name}: {', '.join(scans)}")
+    if problems:
+        raise SystemExit(1)
+    print("Mọi truy vấn đều dùng chỉ mục.")
+
+
 if __name__ == "__main__":
     from app import admin
 
@@ -0,0 +1,116 @@
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+
+from app import db, dao, bench
+from app.models import ScoreSummary, SemesterSummary
+
+# Các bảng lớn, không được phép quét toàn bộ trong các truy vấn thường dùng
+LARGE_TABLES = {'user', 'profile', 'score', 'score_summary', 'semester_summary', 'schedule'}
+
+
+def migrate():
+    # Đưa cơ sở dữ liệu đang chạy về đúng với models: tạo bảng mới, thêm cột và chỉ mục còn thiếu.
+    # Chạy lại nhiều lần không sao, chỉ những gì còn thiếu mới được tạo.
+    tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    applied = [table.name for table in db.metadata.sorted_tables if table.name not in tables]
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            columns = {c['name']: c for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                if column.name not in columns:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+                    applied.append(f'{table.name}.{column.name}')
+                elif _needs_fsp(column, columns[column.name]):
+                    conn.execute(text(f'ALTER TABLE {table.name} MODIFY COLUMN {ddl}'))
+                    applied.append(f'{table.name}.{column.name} (phần lẻ giây)')
+
+            indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    applied.append(index.name)
+
+    # Bảng tổng hợp mới tạo trên cơ sở dữ liệu đã có điểm phải được tính ngay,
+    # nếu không thống kê, điểm trung bình và xếp hạng sẽ trống
+    if {ScoreSummary.__tablename__, SemesterSummary.__tablename__} - tables:
+        applied.append(f'{dao.rebuild_score_summary()} dòng {ScoreSummary.__tablename__}')
+    return applied
+
+
+def _needs_fsp(column, reflected):
+    # Cột DATETIME khai báo có phần lẻ giây (fsp, chỉ MySQL) nhưng cột đang có thì không
+    fsp = getattr(column.type.dialect_impl(db.engine.dialect), 'fsp', None)
+    return bool(fsp) and getattr(reflected['type'], 'fsp', None) != fsp
+
+
+def _hot_queries(s):
+    # Các hàm dao được gọi nhiều nhất; s là mẫu id lấy từ bench._sample
+    return {
+        'get_students_by_class': lambda: dao.get_students_by_class(s["class_id"]),
+        'get_students_scores': lambda: dao.get_students_scores(s["class_id"], s["subject_id"], s["semester_id"]),
+        'get_gradebook': lambda: dao.get_gradebook(s["class_id"], s["subject_id"], s["semester_id"]),
+        'import_scores (đếm điểm hiện có)': lambda: dao._count_class_scores([s["student_id"]], s["subject_id"],
+                                                                           s["semester_id"]),
+        'get_statistics': lambda: dao.get_statistics(s["subject_id"], s["semester_id"]),
+        'get_scores': lambda: dao.get_scores(s["student_id"]),
+        'get_transcript': lambda: dao.get_transcript(s["student_id"]),
+        'get_classes_and_subjects': lambda: dao.get_classes_and_subjects(s["teacher_id"], s["semester_id"]),
+    }
+
+
+@contextmanager
+def _record_statements():
+    # Ghi lại các câu SELECT (kèm tham số) mà hàm dao thực sự gửi tới cơ sở dữ liệu
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _table_name(name):
+    # Bảng được nạp kèm (joinedload) có bí danh dạng profile_1
+    return re.sub(r'_\d+$', '', name.strip('"`'))
+
+
+def _full_scans(statement, parameters):
+    # Trả về các bảng lớn bị quét toàn bộ theo kế hoạch thực thi của cơ sở dữ liệu
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'sqlite':
+            rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+            return [row[-1] for row in rows
+                    if row[-1].startswith('SCAN ') and _table_name(row[-1].split()[1]) in LARGE_TABLES]
+
+        rows = conn.exec_driver_sql(f'EXPLAIN {statement}', parameters).mappings().all()
+        return [f"{row['table']} (type=ALL)" for row in rows
+                if row['type'] == 'ALL' and _table_name(row['table'] or '') in LARGE_TABLES]
+
+
+def check_query_plans():
+    # {tên hàm dao: danh sách bảng bị quét toàn bộ}; rỗng nghĩa là mọi truy vấn đều dùng chỉ mục.
+    # Nên chạy trên cơ sở dữ liệu đã có dữ liệu, với bảng quá nhỏ bộ tối ưu có thể chọn quét toàn bộ.
+    problems = {}
+    for name, fn in _hot_queries(bench._sample()).items():
+        # Xoá cache để hàm thực sự truy vấn
+        bench.clear_caches()
+        with _record_statements() as statements:
+            fn()
+        scans = []
+        for statement, parameters in statements:
+            scans += [scan for scan in _full_scans(statement, parameters) if scan not in scans]
+        if scans:
+            problems[name] = scans
+    return problems
@@ -3,6 +3,7 @@ from datetime import datetime
 
 from app import db, app
 from sqlalchemy import Column, Integer, String, Date, DateTime, Float, Boolean, Enum, ForeignKey
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import relationship
 from flask_login import UserMixin
 
@@ -27,6 +28,9 @@ class User(db.Model, UserMixin):
     scores = relationship('Score', backref='user', lazy=True)
     schedules = relationship('Schedule', backref='user', lazy=True)
     class_id = Column(Integer, ForeignKey('class.id'))
+    __table_args__ = (
+        db.Index('ix_user_role_class', 'user_role', 'class_id'),
+    )
 
     def __str__(self):
         return self.username
@@ -65,7 +69,7 @@ class Profile(db.Model):
     address = Column(String(300), nullable=False)
     email = Column(String(100))
     dob = Column(Date)
-    user_id = Column(Integer, ForeignKey(User.id))
+    user_id = Column(Integer, ForeignKey(User.id), index=True)
 
     def __str__(self):
         return self.lastname
@@ -88,6 +92,9 @@ class Semester(db.Model):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(20), nullable=False)
     year = Column(Integer, nullable=False)
+    # Khoảng thời gian của học kì, dùng để lọc lịch dạy; bỏ trống thì lấy mọi lịch dạy
+    start_date = Column(Date)
+    end_date = Column(Date)
     scores = relationship('Score', backref='semester', lazy=True)
 
     def __str__(self):
@@ -111,7 +118,44 @@ class Score(db.Model):
     semester_id = Column(Integer, ForeignKey(Semester.id), nullable=False)
     type_id = Column(Integer, ForeignKey(ScoreType.id), nullable=False)
     score = Column(Float, nullable=False)
-    update_date = Column(DateTime, default=datetime.now())
+    # Truyền hàm (không gọi) để mỗi lần thêm/sửa lấy đúng thời điểm; dùng làm phiên bản cho ETag trang điểm.
+    # Trên MySQL DATETIME mặc định chỉ tới giây, hai lần sửa trong cùng một giây sẽ cho cùng ETag
+    update_date = Column(DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql'), default=datetime.now,
+                         onupdate=datetime.now)
+    __table_args__ = (
+        # Nhập điểm, tổng hợp điểm và bảng điểm của một học sinh
+        db.Index('ix_score_user_subject_semester_type', 'user_id', 'subject_id', 'semester_id', 'type_id'),
+        # Bảng điểm theo lớp / môn / học kì và thống kê
+        db.Index('ix_score_subject_semester_user', 'subject_id', 'semester_id', 'user_id'),
+    )
+
+
+class ScoreSummary(db.Model):
+    __tablename__ = 'score_summary'
+    user_id = Column(Integer, ForeignKey(User.id), primary_key=True)
+    subject_id = Column(Integer, ForeignKey(Subject.id), primary_key=True)
+    semester_id = Column(Integer, ForeignKey(Semester.id), primary_key=True)
+    weighted_sum = Column(Float, nullable=False, default=0)
+    weight_total = Column(Integer, nullable=False, default=0)
+    average = Column(Float)
+    is_passing = Column(Boolean, nullable=False, default=False)
+    __table_args__ = (
+        db.Index('ix_score_summary_subject_semester_user', 'subject_id', 'semester_id', 'user_id'),
+    )
+
+
+class SemesterSummary(db.Model):
+    # Điểm trung bình học kì của từng học sinh, tính một lần theo calculate_semester_averages.
+    # Bảng xếp hạng, kết quả học kì và bảng điểm cùng đọc cột này.
+    __tablename__ = 'semester_summary'
+    user_id = Column(Integer, ForeignKey(User.id), primary_key=True)
+    semester_id = Column(Integer, ForeignKey(Semester.id), primary_key=True)
+    # DOUBLE trên MySQL để đọc lại đúng giá trị đã làm tròn
+    average = Column(Float(precision=53))
+    is_passing = Column(Boolean, nullable=False, default=False)
+    __table_args__ = (
+        db.Index('ix_semester_summary_semester_average', 'semester_id', 'average'),
+    )
 
 
 class Schedule(db.Model):
@@ -121,6 +165,10 @@ class Schedule(db.Model):
     class_id = Column(Integer, ForeignKey(Class.id), primary_key=True)
     start_date = Column(DateTime)
     end_date = Column(DateTime)
+    __table_args__ = (
+        # Lịch dạy của một giáo viên trong khoảng thời gian của học kì
+        db.Index('ix_schedule_user_dates', 'user_id', 'start_date', 'end_date'),
+    )
 
 
 class Regulation(db.Model):
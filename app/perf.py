@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app, db, routing
+
+_local = threading.local()
+_lock = threading.Lock()
+# route -> các mẫu gần nhất (thời gian, số truy vấn, thời gian SQL, mã trạng thái, câu SQL chậm nhất)
+_samples = defaultdict(lambda: deque(maxlen=app.config['PERF_WINDOW']))
+_over_budget = defaultdict(int)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+    return _local.counters
+
+
+@contextmanager
+def count_queries():
+    # Đếm số câu lệnh SQL được gửi tới cơ sở dữ liệu trong khối with (trên luồng hiện tại)
+    counter = {"count": 0, "seconds": 0.0}
+    _counters().append(counter)
+    try:
+        yield counter
+    finally:
+        _counters().remove(counter)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('perf_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['perf_started'].pop()
+
+    for counter in _counters():
+        counter["count"] += 1
+        counter["seconds"] += elapsed
+
+    if has_app_context() and 'perf' in g:
+        stats = g.perf
+        stats["queries"] += 1
+        stats["sql_seconds"] += elapsed
+        if elapsed > stats["slowest"][0]:
+            stats["slowest"] = (elapsed, statement)
+
+
+def _route():
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return '<không khớp route>'
+
+
+@app.before_request
+def start_request_timer():
+    if app.config['PERF_ENABLED'] and request.endpoint != 'static':
+        g.perf = {"started": time.perf_counter(), "queries": 0, "sql_seconds": 0.0, "slowest": (0.0, None)}
+
+
+@app.after_request
+def record_request(response):
+    stats = g.pop('perf', None)
+    if stats is None:
+        return response
+
+    route = _route()
+    elapsed = time.perf_counter() - stats["started"]
+    slowest_seconds, slowest_sql = stats["slowest"]
+    with _lock:
+        _samples[route].append((elapsed, stats["queries"], stats["sql_seconds"], response.status_code,
+                                slowest_seconds, slowest_sql))
+
+    budget = app.config['QUERY_BUDGET']
+    if budget and stats["queries"] > budget:
+        with _lock:
+            _over_budget[route] += 1
+        app.logger.warning('%s %s chạy %d truy vấn SQL, vượt ngân sách %d (%.1f ms)',
+                           request.method, route, stats["queries"], budget, elapsed * 1000)
+    return response
+
+
+def _quantile(values, q):
+    # values đã sắp xếp; lấy theo thứ hạng gần nhất
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def get_route_stats():
+    with _lock:
+        snapshot = {route: list(samples) for route, samples in _samples.items()}
+        over_budget = dict(_over_budget)
+
+    rows = []
+    for route, samples in snapshot.items():
+        durations = sorted(s[0] for s in samples)
+        queries = sorted(s[1] for s in samples)
+        sql_times = sorted(s[2] for s in samples)
+        slowest = max(samples, key=lambda s: s[4])
+        rows.append({
+            "route": route,
+            "requests": len(samples),
+            "errors": sum(1 for s in samples if s[3] >= 500),
+            "latency_ms": {q: round(_quantile(durations, q) * 1000, 2) for q in QUANTILES},
+            "queries": {q: _quantile(queries, q) for q in QUANTILES},
+            "avg_queries": round(sum(queries) / len(queries), 1),
+            "sql_ms": {q: round(_quantile(sql_times, q) * 1000, 2) for q in QUANTILES},
+            "over_budget": over_budget.get(route, 0),
+            "slowest_sql_ms": round(slowest[4] * 1000, 2),
+            "slowest_sql": slowest[5],
+            "_durations": durations,
+            "_queries": queries,
+        })
+    rows.sort(key=lambda r: r["latency_ms"][0.95], reverse=True)
+    return rows
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+        _over_budget.clear()
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text():
+    # Định dạng văn bản của Prometheus, kiểu summary trên cửa sổ các request gần nhất
+    lines = ['# HELP studentapp_request_duration_seconds Thời gian xử lý request theo route',
+             '# TYPE studentapp_request_duration_seconds summary']
+    rows = get_route_stats()
+    for r in rows:
+        route = _label(r["route"])
+        for q in QUANTILES:
+            lines.append(f'studentapp_request_duration_seconds{{route="{route}",quantile="{q}"}} '
+                         f'{r["latency_ms"][q] / 1000}')
+        lines.append(f'studentapp_request_duration_seconds_sum{{route="{route}"}} {sum(r["_durations"])}')
+        lines.append(f'studentapp_request_duration_seconds_count{{route="{route}"}} {r["requests"]}')
+
+    lines += ['# HELP studentapp_request_sql_queries Số câu lệnh SQL mỗi request theo route',
+              '# TYPE studentapp_request_sql_queries summary']
+    for r in rows:
+        route = _label(r["route"])
+        for q in QUANTILES:
+            lines.append(f'studentapp_request_sql_queries{{route="{route}",quantile="{q}"}} {r["queries"][q]}')
+        lines.append(f'studentapp_request_sql_queries_sum{{route="{route}"}} {sum(r["_queries"])}')
+        lines.append(f'studentapp_request_sql_queries_count{{route="{route}"}} {r["requests"]}')
+
+    lines += ['# HELP studentapp_query_budget_exceeded_total Số request vượt ngân sách truy vấn',
+              '# TYPE studentapp_query_budget_exceeded_total counter']
+    for r in rows:
+        lines.append(f'studentapp_query_budget_exceeded_total{{route="{_label(r["route"])}"}} {r["over_budget"]}')
+
+    pools = routing.get_pool_stats(db.engines)
+    for metric, key, kind, description in (
+            ('db_pool_checkouts_total', 'checkouts', 'counter', 'Số lần lấy kết nối từ pool'),
+            ('db_pool_wait_seconds_total', 'wait_seconds', 'counter', 'Tổng thời gian chờ lấy kết nối'),
+            ('db_pool_timeouts_total', 'timeouts', 'counter', 'Số lần hết thời gian chờ kết nối'),
+            ('db_pool_checked_out', 'checked_out', 'gauge', 'Số kết nối đang được dùng'),
+            ('db_pool_overflow', 'overflow', 'gauge', 'Số kết nối vượt pool_size')):
+        lines += [f'# HELP studentapp_{metric} {description}', f'# TYPE studentapp_{metric} {kind}']
+        for pool in pools:
+            if key in pool:
+                lines.append(f'studentapp_{metric}{{pool="{pool["name"]}"}} {pool[key]}')
+    return '\n'.join(lines) + '\n'
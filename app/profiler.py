@@ -0,0 +1,212 @@
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request
+from flask_login import current_user
+
+from app import app
+
+# Trạng thái bật nằm trong file ARMED_FILE ở PROFILE_DIR để mọi worker cùng thấy:
+# {"id", "route", "user_id", "count", "interval"}. Mỗi request được đo giành một lượt bằng cách tạo
+# file <ARMED_FILE>.<id>.<lượt> (O_EXCL), nên tổng số request được đo không vượt quá count.
+ARMED_FILE = 'armed.json'
+
+_lock = threading.Lock()
+# Bản đọc gần nhất của file trạng thái: (mtime, trạng thái hoặc None)
+_armed = (None, None)
+
+
+class Sampler(threading.Thread):
+    # Luồng phụ chụp ngăn xếp của luồng đang xử lý request theo chu kỳ interval giây
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if self._stopped.is_set():
+                # Luồng request đã kết thúc và đang chờ stop(), mẫu này không còn ý nghĩa
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+def _path(name):
+    return os.path.join(app.config['PROFILE_DIR'], name)
+
+
+def _slots(armed):
+    prefix = f'{ARMED_FILE}.{armed["id"]}.'
+    return [name for name in os.listdir(app.config['PROFILE_DIR']) if name.startswith(prefix)]
+
+
+def arm(route=None, user_id=None, count=1, interval=0.005):
+    # Bật profiler cho count request kế tiếp khớp route (endpoint hoặc rule) và/hoặc user_id.
+    # Chu kỳ bằng 0 làm luồng lấy mẫu quay liên tục và giành GIL với chính request đang đo.
+    if not route and not user_id:
+        raise ValueError('Cần route hoặc mã người dùng.')
+    if not (0 < interval < math.inf):
+        raise ValueError('Chu kỳ lấy mẫu phải là số dương.')
+    if count < 1:
+        raise ValueError('Số request cần đo phải từ 1 trở lên.')
+    disarm()
+    armed = {"id": f'{time.time_ns()}', "route": route or None, "user_id": user_id, "count": count,
+             "interval": interval}
+    # Ghi file tạm rồi đổi tên để worker khác không đọc phải file ghi dở
+    temporary = _path(f'{ARMED_FILE}.{armed["id"]}.tmp')
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(armed, f)
+    os.replace(temporary, _path(ARMED_FILE))
+
+
+def disarm():
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    for name in os.listdir(app.config['PROFILE_DIR']):
+        if name.startswith(ARMED_FILE):
+            try:
+                os.remove(_path(name))
+            except FileNotFoundError:
+                pass
+
+
+def _load_armed():
+    # Mỗi request chỉ tốn một lần stat; file chỉ được đọc lại khi mtime đổi
+    global _armed
+    try:
+        mtime = os.stat(_path(ARMED_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if _armed[0] != mtime:
+        armed = None
+        if mtime is not None:
+            try:
+                with open(_path(ARMED_FILE), encoding='utf-8') as f:
+                    armed = json.load(f)
+            except (FileNotFoundError, ValueError):
+                mtime = None
+        with _lock:
+            _armed = (mtime, armed)
+    return _armed[1]
+
+
+def get_armed():
+    # Trạng thái hiện tại kèm số request còn lại, dùng cho trang quản trị
+    armed = _load_armed()
+    if armed is None:
+        return None
+    remaining = armed["count"] - len(_slots(armed))
+    return {**armed, "remaining": remaining} if remaining > 0 else None
+
+
+def _take_slot(armed):
+    if armed["route"] and armed["route"] not in (request.endpoint,
+                                                 request.url_rule.rule if request.url_rule else None):
+        return None
+    if armed["user_id"] and (not current_user.is_authenticated or current_user.id != armed["user_id"]):
+        return None
+    for slot in range(armed["count"]):
+        try:
+            os.close(os.open(_path(f'{ARMED_FILE}.{armed["id"]}.{slot}'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        if slot == armed["count"] - 1:
+            # Lượt cuối: tắt cho mọi worker; file lượt được xoá ở lần bật/tắt sau
+            try:
+                os.remove(_path(ARMED_FILE))
+            except FileNotFoundError:
+                pass
+        return armed["interval"]
+    return None
+
+
+@app.before_request
+def start_profiler():
+    # Khi chưa bật thì chỉ tốn một lần stat file trạng thái
+    armed = _load_armed()
+    if armed is None:
+        return
+    interval = _take_slot(armed)
+    if interval is not None:
+        g.profiler = Sampler(threading.get_ident(), interval)
+        g.profiler_started = time.perf_counter()
+        g.profiler.start()
+
+
+@app.teardown_request
+def stop_profiler(exc):
+    sampler = g.pop('profiler', None)
+    if sampler is not None:
+        elapsed = time.perf_counter() - g.pop('profiler_started')
+        write_profile(sampler.stop(), sampler.interval, elapsed)
+
+
+def _self_times(stacks):
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return own, total
+
+
+def write_profile(stacks, interval, elapsed):
+    directory = app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    user = current_user.id if current_user.is_authenticated else 'anonymous'
+    slug = re.sub(r'[^A-Za-z0-9_]+', '_', request.endpoint or 'unknown').strip('_')
+    name = f'{datetime.now():%Y%m%d-%H%M%S-%f}_{slug}_{user}'
+
+    # Định dạng collapsed stack, dùng trực tiếp với flamegraph.pl hoặc speedscope
+    with open(os.path.join(directory, name + '.collapsed'), 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+
+    samples = sum(stacks.values())
+    own, total = _self_times(stacks)
+    with open(os.path.join(directory, name + '.txt'), 'w', encoding='utf-8') as f:
+        f.write(f'{request.method} {request.full_path}\n')
+        f.write(f'Người dùng: {user}\n')
+        f.write(f'Thời gian: {elapsed * 1000:.1f} ms, {samples} mẫu, chu kỳ {interval * 1000:g} ms\n\n')
+        f.write(f'{"self %":>8} {"total %":>8} {"self ms":>9}  hàm\n')
+        for frame, count in own.most_common(50):
+            f.write(f'{count * 100 / samples:8.1f} {total[frame] * 100 / samples:8.1f} '
+                    f'{count * interval * 1000:9.1f}  {frame}\n')
+    return name
+
+
+def list_profiles():
+    directory = app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name for name in os.listdir(directory) if name.endswith(('.txt', '.collapsed'))), reverse=True)
+
+
+def read_profile(name):
+    # Chỉ đọc các file có trong thư mục profile, không theo đường dẫn do người dùng đưa vào
+    if name not in list_profiles():
+        return None
+    with open(os.path.join(app.config['PROFILE_DIR'], name), encoding='utf-8') as f:
+        return f.read()
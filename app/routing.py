@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import defaultdict
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+REPLICA_BIND = 'replica'
+
+_pool_lock = threading.Lock()
+# tên pool ("primary" / "replica") -> số lần lấy kết nối, thời gian chờ, số lần hết thời gian chờ
+_pool_stats = defaultdict(lambda: {"checkouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "timeouts": 0,
+                                   "connects": 0})
+
+
+class RoutingSession(Session):
+    # Truy vấn trong hàm đánh dấu read_only đọc từ bản sao (bind "replica") nếu có cấu hình.
+    # Ghi luôn vào primary, và khi session đã ghi thì mọi truy vấn sau đó cũng về primary
+    # để người dùng đọc được đúng dữ liệu vừa ghi. 'sticky' là request của người dùng vừa ghi ở
+    # request trước: chỉ đọc từ primary, không tính là đã ghi.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('read_only') and not self.info.get('wrote') \
+                and not self.info.get('sticky') and not self._flushing:
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _do_orm_execute(orm_execute_state):
+    # INSERT/UPDATE/DELETE viết bằng câu lệnh (không qua flush)
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool có đo thời gian chờ lấy kết nối; tên pool lấy từ pool_logging_name
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            with _pool_lock:
+                _pool_stats[self._name()]["timeouts"] += 1
+            raise
+
+        waited = time.perf_counter() - start
+        with _pool_lock:
+            stats = _pool_stats[self._name()]
+            stats["checkouts"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        return connection
+
+    def _create_connection(self):
+        with _pool_lock:
+            _pool_stats[self._name()]["connects"] += 1
+        return super()._create_connection()
+
+    def _name(self):
+        return getattr(self, 'logging_name', None) or 'primary'
+
+
+def get_pool_stats(engines):
+    # engines: db.engines; ghép số liệu tích luỹ với trạng thái hiện tại của từng pool
+    with _pool_lock:
+        totals = {name: dict(stats) for name, stats in _pool_stats.items()}
+
+    rows = []
+    for key, engine in engines.items():
+        pool = engine.pool
+        name = getattr(pool, 'logging_name', None) or 'primary'
+        stats = totals.get(name, {"checkouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "timeouts": 0,
+                                  "connects": 0})
+        row = {"name": name, **stats}
+        if isinstance(pool, QueuePool):
+            row.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow(),
+                       idle=pool.checkedin())
+        row["avg_wait_ms"] = round(stats["wait_seconds"] / stats["checkouts"] * 1000, 3) if stats["checkouts"] else 0
+        rows.append(row)
+    return rows
@@ -0,0 +1,79 @@
+import bisect
+import threading
+import time
+
+import unidecode
+
+
+def normalize(text):
+    # Bỏ dấu tiếng Việt và chuyển về chữ thường: "Nguyễn Văn Ánh" -> "nguyen van anh"
+    return unidecode.unidecode(text or '').lower()
+
+
+def tokenize(text):
+    return normalize(text).split()
+
+
+class StudentSearchIndex:
+    # Chỉ mục tiền tố trong bộ nhớ trên họ tên (đã bỏ dấu) và tên tài khoản của học sinh.
+    # loader trả về các dòng (user_id, class_id, username, firstname, lastname).
+    def __init__(self, loader, ttl=300):
+        self._loader = loader
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._built_at = None
+
+    def invalidate(self):
+        self._built_at = None
+
+    def _build(self):
+        entries = []
+        classes = {}
+        names = {}
+        for user_id, class_id, username, firstname, lastname in self._loader():
+            classes[user_id] = class_id
+            names[user_id] = (f'{firstname or ""} {lastname or ""}'.strip(), username)
+            tokens = set(tokenize(firstname) + tokenize(lastname) + tokenize(username))
+            for token in tokens:
+                entries.append((token, user_id))
+        entries.sort()
+        keys = [token for token, _ in entries]
+        ids = [user_id for _, user_id in entries]
+        return keys, ids, classes, names
+
+    def _get_snapshot(self):
+        built_at = self._built_at
+        if built_at is None or time.monotonic() - built_at > self._ttl:
+            with self._lock:
+                if self._built_at is None or time.monotonic() - self._built_at > self._ttl:
+                    self._snapshot = self._build()
+                    self._built_at = time.monotonic()
+        return self._snapshot
+
+    def search(self, kw, class_id=None):
+        keys, ids, classes, names = self._get_snapshot()
+
+        matched = None
+        for term in tokenize(kw):
+            # Mọi token bắt đầu bằng term nằm liền nhau trong danh sách đã sắp xếp
+            lo = bisect.bisect_left(keys, term)
+            hi = bisect.bisect_left(keys, term + '\uffff')
+            found = set(ids[lo:hi])
+            matched = found if matched is None else matched & found
+            if not matched:
+                return []
+
+        if matched is None:
+            return []
+
+        if class_id:
+            class_id = int(class_id)
+            matched = {user_id for user_id in matched if classes.get(user_id) == class_id}
+
+        return sorted(matched)
+
+    def suggest(self, kw, limit=10):
+        names = self._get_snapshot()[3]
+        return [{"id": user_id, "name": names[user_id][0], "username": names[user_id][1]}
+                for user_id in self.search(kw)[:limit]]
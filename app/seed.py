@@ -0,0 +1,119 @@
+import hashlib
+import math
+import random
+from datetime import date, datetime
+
+from sqlalchemy import insert, update
+
+from app import db, dao
+from app.models import User, Grade, Class, Subject, Semester, ScoreType, Score, Schedule, Regulation, Profile, \
+    UserRoleEnum
+
+SUBJECT_NAMES = ['Toán', 'Ngữ văn', 'Tiếng Anh', 'Vật lý', 'Hóa học', 'Sinh học', 'Lịch sử', 'Địa lý',
+                 'Tin học', 'GDCD']
+FIRSTNAMES = ['Nguyễn Văn', 'Trần Thị', 'Lê Minh', 'Phạm Thu', 'Hoàng Đức', 'Võ Ngọc', 'Đặng Quốc', 'Bùi Thanh']
+LASTNAMES = ['An', 'Bình', 'Châu', 'Dũng', 'Giang', 'Hà', 'Khánh', 'Linh', 'Minh', 'Nam', 'Phúc', 'Quân',
+             'Thảo', 'Trang', 'Vy', 'Yến']
+
+# Số lần nhập điểm tối đa của mỗi loại, điểm sinh ra ngẫu nhiên từ 1 tới số này
+SCORE_TYPES = [('15 phút', 5), ('1 tiết', 3), ('Điểm thi', 1)]
+
+BATCH_SIZE = 10000
+
+
+def _insert(model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(insert(model), rows[start:start + BATCH_SIZE])
+
+
+def _ids(model):
+    return [row_id for row_id, in db.session.query(model.id).order_by(model.id)]
+
+
+def generate_school(students=1000, grades=3, class_size=40, subjects=8, semesters=2, unassigned=0, seed=0):
+    # Sinh dữ liệu một trường với số lượng tuỳ chọn vào cơ sở dữ liệu đang cấu hình (SQLite hoặc MySQL).
+    # Xoá toàn bộ dữ liệu cũ. unassigned là số học sinh mới tiếp nhận chưa được xếp lớp.
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    password = str(hashlib.md5('123456'.encode('utf-8')).hexdigest())
+
+    _insert(Grade, [{"name": f'Khối {10 + g}'} for g in range(grades)])
+    _insert(ScoreType, [{"name": name} for name, _ in SCORE_TYPES])
+    _insert(Semester, [{"name": f'Học kì {s % 2 + 1}', "year": 2020 + s // 2,
+                        "start_date": date(2020 + s // 2, 9, 1) if s % 2 == 0 else date(2021 + s // 2, 1, 16),
+                        "end_date": date(2021 + s // 2, 1, 15) if s % 2 == 0 else date(2021 + s // 2, 5, 31)}
+                       for s in range(semesters)])
+    _insert(Regulation, [{"min_age": 15, "max_age": 20, "max_class_size": class_size,
+                          "max_students": students + unassigned + 1000}])
+    grade_ids, type_ids, semester_ids = _ids(Grade), _ids(ScoreType), _ids(Semester)
+
+    # Lớp và môn học của từng khối
+    per_grade = math.ceil(students / grades)
+    classes_per_grade = math.ceil(per_grade / class_size)
+    _insert(Class, [{"name": f'{10 + g}A{c + 1}', "grade_id": grade_id, "quantity": 0}
+                    for g, grade_id in enumerate(grade_ids) for c in range(classes_per_grade)])
+    _insert(Subject, [{"name": SUBJECT_NAMES[s % len(SUBJECT_NAMES)], "grade_id": grade_id}
+                      for grade_id in grade_ids for s in range(subjects)])
+    classes = db.session.query(Class.id, Class.grade_id).order_by(Class.id).all()
+    subjects_by_grade = {}
+    for subject_id, grade_id in db.session.query(Subject.id, Subject.grade_id):
+        subjects_by_grade.setdefault(grade_id, []).append(subject_id)
+
+    # Tài khoản: quản trị, giáo viên (mỗi giáo viên dạy khoảng 5 lớp-môn) và học sinh
+    teachers = max(1, len(classes) * subjects // 5)
+    users = [{"username": 'admin', "password": password, "user_role": UserRoleEnum.ADMIN}]
+    users += [{"username": f'gv{t + 1}', "password": password, "user_role": UserRoleEnum.TEACHER}
+              for t in range(teachers)]
+    quantities = {}
+    for s in range(students + unassigned):
+        class_id = classes[s % len(classes)][0] if s < students else None
+        if class_id:
+            quantities[class_id] = quantities.get(class_id, 0) + 1
+        users.append({"username": f'hs{s + 1}', "password": password, "user_role": UserRoleEnum.STUDENT,
+                      "class_id": class_id})
+    _insert(User, users)
+    db.session.execute(update(Class), [{"id": class_id, "quantity": q} for class_id, q in quantities.items()])
+
+    user_rows = db.session.query(User.id, User.user_role, User.class_id).order_by(User.id).all()
+    teacher_ids = [user_id for user_id, role, _ in user_rows if role == UserRoleEnum.TEACHER]
+    student_rows = [(user_id, class_id) for user_id, role, class_id in user_rows if role == UserRoleEnum.STUDENT]
+
+    _insert(Profile, [{"firstname": rng.choice(FIRSTNAMES), "lastname": rng.choice(LASTNAMES),
+                       "gender": rng.choice(['Nam', 'Nữ']), "address": 'TP. Hồ Chí Minh',
+                       "dob": date(2008, rng.randint(1, 12), rng.randint(1, 28)), "user_id": user_id}
+                      for user_id, _, _ in user_rows if user_id != 1])
+
+    # Lịch dạy: mỗi (lớp, môn) một giáo viên cho cả năm học
+    schedules = []
+    for class_id, grade_id in classes:
+        for subject_id in subjects_by_grade[grade_id]:
+            schedules.append({"user_id": rng.choice(teacher_ids), "subject_id": subject_id, "class_id": class_id,
+                              "start_date": datetime(2020, 9, 1), "end_date": datetime(2020 + semesters, 6, 1)})
+    schedules = list({(s["user_id"], s["subject_id"], s["class_id"]): s for s in schedules}.values())
+    _insert(Schedule, schedules)
+
+    # Điểm: mỗi học sinh đã xếp lớp, mỗi môn của khối, mỗi học kì
+    class_grades = dict(classes)
+    scores = []
+    count = 0
+    for user_id, class_id in student_rows:
+        if class_id is None:
+            continue
+        for subject_id in subjects_by_grade[class_grades[class_id]]:
+            for semester_id in semester_ids:
+                for type_id, (_, quota) in zip(type_ids, SCORE_TYPES):
+                    for _ in range(rng.randint(1, quota)):
+                        scores.append({"user_id": user_id, "subject_id": subject_id, "semester_id": semester_id,
+                                       "type_id": type_id, "score": rng.randint(0, 40) / 4})
+        if len(scores) >= BATCH_SIZE:
+            _insert(Score, scores)
+            count += len(scores)
+            scores = []
+    _insert(Score, scores)
+    count += len(scores)
+    db.session.commit()
+
+    dao.rebuild_score_summary()
+    return {"students": students, "unassigned": unassigned, "teachers": teachers, "classes": len(classes),
+            "schedules": len(schedules), "scores": count}
@@ -0,0 +1,140 @@
+import codecs
+import csv
+import tempfile
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+from flask import Response, stream_with_context
+from werkzeug.utils import secure_filename
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def read_rows(file):
+    # Đọc file CSV hoặc XLSX đã tải lên thành các dict theo dòng tiêu đề, đọc dần từng dòng
+    filename = (file.filename or '').lower()
+    if filename.endswith('.xlsx'):
+        return _read_xlsx(file.stream)
+    if filename.endswith('.csv'):
+        return _read_csv(file.stream)
+    raise ValueError('Chỉ hỗ trợ file CSV hoặc XLSX.')
+
+
+def _read_csv(stream):
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    for row in csv.DictReader(lines):
+        yield {key.strip().lower(): value for key, value in row.items() if key}
+
+
+def _read_xlsx(stream):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell).strip().lower() if cell is not None else '' for cell in next(rows, [])]
+        for values in rows:
+            yield {key: value for key, value in zip(header, values) if key}
+    finally:
+        workbook.close()
+
+
+class _Echo:
+    # csv.writer ghi vào đây và nhận lại đúng dòng vừa ghi, không cần bộ đệm
+    def write(self, value):
+        return value
+
+
+def _stream_csv(header, rows):
+    writer = csv.writer(_Echo())
+    # BOM để Excel nhận đúng tiếng Việt
+    yield '\ufeff' + writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+_XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>',
+}
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('<c/>')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            if isinstance(value, (date, datetime)):
+                value = value.isoformat(sep=' ') if isinstance(value, datetime) else value.isoformat()
+            # Chuỗi ghi trực tiếp trong ô (inlineStr) nên không phải giữ bảng chuỗi dùng chung trong bộ nhớ
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def _stream_xlsx(header, rows, chunk_size=64 * 1024):
+    # Ghi từng dòng vào file zip tạm rồi gửi theo từng khối; openpyxl ở chế độ write-only
+    # vẫn giữ bảng chuỗi dùng chung (và cả cây XML nếu thiếu lxml) nên bộ nhớ tăng theo số dòng
+    with tempfile.TemporaryFile() as file:
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in _XLSX_PARTS.items():
+                archive.writestr(name, content)
+            with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+                sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                            b'<sheetData>')
+                sheet.write(_xlsx_row(header).encode('utf-8'))
+                for row in rows:
+                    sheet.write(_xlsx_row(row).encode('utf-8'))
+                sheet.write(b'</sheetData></worksheet>')
+
+        file.seek(0)
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def export_response(filename, header, rows, export_type):
+    # rows là iterator; dữ liệu được đọc dần trong lúc gửi response
+    if export_type == 'csv':
+        body = _stream_csv(header, rows)
+    elif export_type == 'xlsx':
+        body = _stream_xlsx(header, rows)
+    else:
+        raise ValueError('Chỉ hỗ trợ xuất CSV hoặc XLSX.')
+
+    return Response(stream_with_context(body), mimetype=EXPORT_MIMETYPES[export_type],
+                    headers={'Content-Disposition': 'attachment;filename=%s' % secure_filename(filename)})
@@ -0,0 +1,75 @@
+import io
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cloudinary.uploader
+from PIL import Image
+
+from app import app, db, dao
+from app.models import User
+
+# Các kích thước ảnh đại diện được tạo sau khi tải lên (cạnh vuông, đơn vị px)
+AVATAR_SIZES = {'avatar': 256, 'thumb': 64}
+
+
+class CloudinaryStorage:
+    def save(self, key, data, sizes):
+        # Cloudinary tự tạo các bản thu nhỏ (eager) trong cùng một lần tải lên
+        res = cloudinary.uploader.upload(data, public_id=key,
+                                         eager=[{'width': s, 'height': s, 'crop': 'fill'} for s in sizes.values()])
+        return {name: eager['secure_url'] for name, eager in zip(sizes, res['eager'])}
+
+
+class LocalStorage:
+    # Lưu ảnh vào thư mục static, dùng khi chạy thử hoặc không có mạng
+    def __init__(self, root, url_prefix):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def save(self, key, data, sizes):
+        os.makedirs(self.root, exist_ok=True)
+        urls = {}
+        for name, size in sizes.items():
+            filename = f'{key}_{name}.png'
+            with open(os.path.join(self.root, filename), 'wb') as f:
+                f.write(_resize(data, size))
+            urls[name] = f'{self.url_prefix}/{filename}'
+        return urls
+
+
+def _resize(data, size):
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size))
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        # Ví dụ JPEG hệ màu CMYK, PNG không lưu được
+        image = image.convert('RGB')
+    out = io.BytesIO()
+    image.save(out, format='PNG')
+    return out.getvalue()
+
+
+def get_storage():
+    if app.config['AVATAR_STORAGE'] == 'local':
+        return LocalStorage(app.config['AVATAR_UPLOAD_DIR'], f'{app.static_url_path}/uploads/avatars')
+    return CloudinaryStorage()
+
+
+_executor = ThreadPoolExecutor(max_workers=app.config['AVATAR_WORKERS'], thread_name_prefix='avatar')
+
+
+def upload_avatar(user_id, data):
+    try:
+        urls = get_storage().save(f'avatar-{user_id}-{uuid.uuid4().hex[:8]}', data, AVATAR_SIZES)
+        with app.app_context():
+            db.session.query(User).filter(User.id == user_id).update({User.avatar: urls['avatar']})
+            db.session.commit()
+        dao.invalidate_user(user_id)
+        return urls
+    except Exception:
+        app.logger.exception('Không tải được ảnh đại diện của user %s', user_id)
+
+
+def submit_avatar(user_id, data):
+    # Tải ảnh ở luồng nền, request đăng ký không phải chờ máy chủ ảnh
+    return _executor.submit(upload_avatar, user_id, data)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+import pytest
+
+# Cơ sở dữ liệu SQLite tạm, phải đặt trước khi import app
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+from app import app as flask_app, dao, perf, seed  # noqa: E402
+from app import index, admin  # noqa: E402,F401  đăng ký route và trang quản trị
+
+flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+
+@pytest.fixture(scope='session')
+def school():
+    # Một trường nhỏ sinh bằng seed.generate_school, dùng chung cho mọi test
+    with flask_app.app_context():
+        summary = seed.generate_school(students=240, grades=2, class_size=40, subjects=4, semesters=2)
+        dao.clear_student_cache()
+        dao.clear_nav_cache()
+    return summary
+
+
+@pytest.fixture
+def app(school):
+    with flask_app.app_context():
+        yield flask_app
+
+
+@pytest.fixture
+def client(school):
+    return flask_app.test_client()
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+def count_queries(client, url, method='get', **kwargs):
+    # Số truy vấn của lần gọi thứ hai; lần đầu nạp các cache dùng chung (menu, quy định) như một worker đã chạy
+    getattr(client, method)(url, **kwargs)
+    with perf.count_queries() as counter:
+        response = getattr(client, method)(url, **kwargs)
+    assert response.status_code == 200
+    return counter["count"], response
@@ -0,0 +1,33 @@
+import pytest
+
+from app import migrate
+from tests.conftest import count_queries, login
+
+# Một trang kết quả tìm kiếm: người dùng kèm hồ sơ (và trang tìm học sinh) trong vài truy vấn, không N+1
+LOOKUP_QUERY_BUDGET = 3
+
+
+@pytest.mark.parametrize('url', [
+    '/admin/score/ajax/lookup/?name=user&query=an',
+    '/admin/profile/ajax/lookup/?name=user&query=an',
+    '/admin/schedule/ajax/lookup/?name=user&query=gv',
+    '/admin/score/ajax/lookup/?name=subject&query=a',
+])
+def test_ajax_lookup_query_budget(client, url):
+    login(client, 1)
+    count, response = count_queries(client, url)
+    assert response.get_json()
+    assert count <= LOOKUP_QUERY_BUDGET
+
+
+def test_profile_user_lookup_uses_search_index(client):
+    login(client, 1)
+    with client.application.app_context():
+        with migrate._record_statements() as statements:
+            teachers = client.get('/admin/profile/ajax/lookup/?name=user&query=gv1').get_json()
+            students = client.get('/admin/profile/ajax/lookup/?name=user&query=hs1').get_json()
+        # Không lọc vai trò nhưng ILIKE chỉ chạy trên giáo viên và quản trị, không quét bảng user
+        scans = [scan for statement, parameters in statements for scan in migrate._full_scans(statement, parameters)]
+    assert scans == []
+    assert teachers and all(label.startswith('gv1') for _, label in teachers)
+    assert students and all(label.startswith('hs1') for _, label in students)
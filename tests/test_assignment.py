@@ -0,0 +1,24 @@
+from sqlalchemy import func
+
+from app import db, dao, perf
+from app.models import Class, User, UserRoleEnum
+
+
+def test_assign_students_in_constant_queries(app):
+    regulation = dao.get_current_regulation()
+    # Đủ học sinh mới để phải mở thêm vài lớp
+    count = regulation.max_class_size * 6
+    db.session.add_all([User(username=f'moi{i}', password='x', user_role=UserRoleEnum.STUDENT)
+                        for i in range(count)])
+    db.session.commit()
+    classes = Class.query.count()
+
+    with perf.count_queries() as counter:
+        dao.assign_students_to_classes()
+    assert counter["count"] <= 10
+
+    assert User.query.filter(User.user_role == UserRoleEnum.STUDENT, User.class_id.is_(None)).count() == 0
+    assert Class.query.count() > classes
+    sizes = dict(db.session.query(User.class_id, func.count(User.id)).group_by(User.class_id))
+    for c in Class.query:
+        assert c.quantity == sizes.get(c.id, 0) <= regulation.max_class_size
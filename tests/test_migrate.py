@@ -0,0 +1,41 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.dialects import mysql
+from sqlalchemy.schema import CreateColumn
+
+from app import db, migrate
+from app.models import Score, ScoreSummary, SemesterSummary
+
+
+def test_hot_queries_use_indexes(app):
+    assert migrate.check_query_plans() == {}
+
+
+def test_missing_index_is_reported(app):
+    db.session.remove()
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX ix_score_user_subject_semester_type'))
+    # sqlite3 giữ kế hoạch EXPLAIN cũ trong cache câu lệnh của kết nối trong pool
+    db.engine.dispose()
+    try:
+        # Kế hoạch lấy từ câu SQL thật của dao.get_scores, không phải bản sao chép
+        assert 'get_scores' in migrate.check_query_plans()
+    finally:
+        assert 'ix_score_user_subject_semester_type' in migrate.migrate()
+        db.engine.dispose()
+
+
+@pytest.mark.parametrize('model', [ScoreSummary, SemesterSummary])
+def test_migrate_fills_new_summary_table(app, model):
+    count = model.query.count()
+    db.session.remove()
+    model.__table__.drop(db.engine)
+
+    applied = migrate.migrate()
+    assert model.__tablename__ in applied
+    assert model.query.count() == count > 0
+
+
+def test_score_update_date_keeps_microseconds_on_mysql():
+    ddl = CreateColumn(Score.__table__.c.update_date).compile(dialect=mysql.dialect())
+    assert str(ddl) == 'update_date DATETIME(6)'
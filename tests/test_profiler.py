@@ -0,0 +1,54 @@
+import pytest
+
+from app import profiler
+from tests.conftest import login
+
+
+@pytest.fixture(autouse=True)
+def profile_dir(app, tmp_path, monkeypatch):
+    # Profile và file trạng thái ghi vào thư mục tạm thay vì instance/profiles
+    monkeypatch.setitem(app.config, 'PROFILE_DIR', str(tmp_path))
+    yield tmp_path
+    profiler.disarm()
+
+
+@pytest.mark.parametrize('interval', [0, -0.005, float('nan'), float('inf')])
+def test_arm_rejects_non_positive_interval(interval):
+    with pytest.raises(ValueError):
+        profiler.arm('index', interval=interval)
+    assert profiler.get_armed() is None
+
+
+def test_admin_form_rejects_zero_interval(client):
+    login(client, 1)
+    response = client.post('/admin/myprofilerview/', data={'route': 'index', 'interval': '0'},
+                           follow_redirects=True)
+    assert 'Thông tin không hợp lệ.' in response.get_data(as_text=True)
+    assert profiler.get_armed() is None
+
+
+def test_admin_form_requires_route_or_user(client):
+    login(client, 1)
+    response = client.post('/admin/myprofilerview/', data={'route': '', 'user_id': ''}, follow_redirects=True)
+    assert 'Thông tin không hợp lệ.' in response.get_data(as_text=True)
+    assert profiler.get_armed() is None
+
+
+def test_arm_for_a_user_on_any_route(client):
+    login(client, 1)
+    client.post('/admin/myprofilerview/', data={'user_id': '1', 'count': '2'})
+    assert profiler.get_armed()["remaining"] == 2
+
+    client.get('/about')
+    client.get('/teachers')
+    assert profiler.get_armed() is None
+    assert len([name for name in profiler.list_profiles() if name.endswith('.txt')]) == 2
+
+
+def test_armed_state_is_shared_between_workers(client):
+    profiler.arm('about_page', count=1)
+    # Worker khác: chưa đọc file trạng thái lần nào
+    profiler._armed = (None, None)
+    client.get('/about')
+    assert profiler.get_armed() is None
+    assert [name for name in profiler.list_profiles() if name.endswith('.txt')]
@@ -0,0 +1,41 @@
+import pytest
+
+from app.models import User, Schedule, UserRoleEnum
+from tests.conftest import count_queries, login
+
+# Số truy vấn tối đa của các trang danh sách, không phụ thuộc số học sinh
+QUERY_BUDGETS = {
+    'index': 5,
+    'class_detail': 4,
+    'teachers': 4,
+    'input_scores': 6,
+}
+
+
+def test_index_defaults_to_first_page(app, client):
+    # Trang chủ không có page/after chỉ nạp trang đầu, không nạp cả trường
+    assert count_queries(client, '/')[0] <= QUERY_BUDGETS['index']
+    assert client.get('/').get_data(as_text=True).count('<th scope="row">') == app.config['PAGE_SIZE']
+
+
+def test_class_detail(app, client):
+    class_id = User.query.filter_by(user_role=UserRoleEnum.STUDENT).first().class_id
+    assert count_queries(client, f'/classes/{class_id}')[0] <= QUERY_BUDGETS['class_detail']
+
+
+def test_teachers(app, client):
+    assert count_queries(client, '/teachers')[0] <= QUERY_BUDGETS['teachers']
+
+
+def test_input_scores(app, client):
+    schedule = Schedule.query.first()
+    login(client, schedule.user_id)
+    url = f'/input_scores/{schedule.class_id}/{schedule.subject_id}/1'
+    assert count_queries(client, url)[0] <= QUERY_BUDGETS['input_scores']
+
+
+
+@pytest.mark.parametrize('query', ['class_id=abc', 'after=abc', 'kw=an&class_id=abc', 'grade_id=abc', 'page=abc',
+                                   'page=0'])
+def test_index_ignores_malformed_ids(client, query):
+    assert client.get(f'/?{query}').status_code == 200
@@ -0,0 +1,29 @@
+import pytest
+
+from app import dao
+from app.models import Grade
+from tests.conftest import login
+
+
+@pytest.mark.parametrize('semester_id', [1, 2])
+def test_leaderboard_matches_semester_results(app, semester_id):
+    grade_id = Grade.query.first().id
+    results = {r["user_id"]: r for r in dao.compute_semester_results(semester_id, grade_id=grade_id)}
+    leaderboard = dao.get_leaderboard(semester_id, 'grade', grade_id)
+    assert leaderboard
+    for row in leaderboard:
+        assert (row["average"], row["rank"]) == (results[row["user_id"]]["gpa"], results[row["user_id"]]["rank"])
+
+
+def test_leaderboard_cache_expires(app):
+    key = (1, None, 'school', None)
+    rows = dao.get_leaderboard(1, 'school')
+    # Hết hạn như ở một worker khác sau LEADERBOARD_CACHE_TTL
+    dao._leaderboard_cache[key] = (0, [])
+    assert dao.get_leaderboard(1, 'school') == rows
+
+
+@pytest.mark.parametrize('query', ['scope=grade&grade_id=abc', 'scope=class&class_id=abc', 'semester_id=abc'])
+def test_rankings_rejects_non_numeric_ids(client, query):
+    login(client, 1)
+    assert client.get(f'/rankings?{query}').status_code == 404
@@ -0,0 +1,25 @@
+from app import app as flask_app, db, dao, perf
+from app.models import Regulation
+
+
+def test_about_page_runs_no_queries(client):
+    client.get('/about')
+    with perf.count_queries() as counter:
+        assert client.get('/about').status_code == 200
+    assert counter["count"] == 0
+
+
+def test_new_regulation_seen_on_next_request(school):
+    with flask_app.app_context():
+        current = dao.get_current_regulation()
+        # Một worker khác thêm quy định mới, worker này không được xoá cache
+        db.session.add(Regulation(min_age=current.min_age, max_age=current.max_age,
+                                  max_class_size=current.max_class_size + 5, max_students=current.max_students))
+        db.session.commit()
+        # Trong cùng request vẫn dùng bản đã kiểm tra
+        assert dao.get_current_regulation() == current
+
+    with flask_app.app_context():
+        assert dao.get_current_regulation().max_class_size == current.max_class_size + 5
+        Regulation.query.filter(Regulation.id > current.id).delete()
+        db.session.commit()
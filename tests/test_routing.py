@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+from sqlalchemy import create_engine, insert
+
+from app import db, dao, routing
+from app.models import Grade, Schedule, Score, User, UserRoleEnum
+from tests.conftest import login
+
+REPLICA_GRADE = 'Khối bản sao'
+
+
+@pytest.fixture
+def replica_configured(app, tmp_path, monkeypatch):
+    # Bản sao là một file SQLite thứ hai với dữ liệu khác primary, để biết mỗi truy vấn đọc từ đâu
+    url = 'sqlite:///' + str(tmp_path / 'replica.db')
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Grade), [{"id": 999, "name": REPLICA_GRADE}])
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS', {routing.REPLICA_BIND: url})
+    monkeypatch.setitem(db.engines, routing.REPLICA_BIND, engine)
+    db.session.remove()
+    yield
+    db.session.remove()
+    engine.dispose()
+
+
+def _grade_names(grades):
+    return {grade.name for grade in grades}
+
+
+def test_read_only_queries_use_replica(replica_configured):
+    assert _grade_names(dao.get_grades()) == {REPLICA_GRADE}
+    # Truy vấn không đánh dấu read_only vẫn đọc primary
+    assert REPLICA_GRADE not in _grade_names(Grade.query.all())
+
+
+def test_reads_after_write_stay_on_primary(replica_configured):
+    grade = Grade(name='Khối mới')
+    db.session.add(grade)
+    db.session.flush()
+    assert 'Khối mới' in _grade_names(dao.get_grades())
+
+    db.session.commit()
+    try:
+        assert 'Khối mới' in _grade_names(dao.get_grades())
+    finally:
+        db.session.delete(grade)
+        db.session.commit()
+
+
+def test_sticky_reads_use_primary(replica_configured):
+    db.session.info['sticky'] = True
+    assert REPLICA_GRADE not in _grade_names(dao.get_grades())
+
+
+def _primary_until(client):
+    with client.session_transaction() as session:
+        return session.get('primary_until')
+
+
+def test_reads_inside_sticky_window_do_not_extend_it(client, replica_configured):
+    until = time.time() + 3
+    with client.session_transaction() as session:
+        session['primary_until'] = until
+    assert client.get('/teachers').status_code == 200
+    assert _primary_until(client) == until
+
+
+def test_write_extends_sticky_window(app, client, replica_configured):
+    schedule = Schedule.query.first()
+    student = User.query.filter_by(user_role=UserRoleEnum.STUDENT, class_id=schedule.class_id).first()
+    # Chỗ trống cho một điểm 15 phút mới
+    Score.query.filter_by(user_id=student.id, subject_id=schedule.subject_id, semester_id=2, type_id=1).delete()
+    db.session.commit()
+    login(client, schedule.user_id)
+    response = client.post(f'/gradebook/{schedule.class_id}/{schedule.subject_id}/2',
+                           json={"changes": [{"student_id": student.id, "type_id": 1, "score": "8"}]})
+    assert response.status_code == 200
+    assert _primary_until(client) > time.time()
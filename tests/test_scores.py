@@ -0,0 +1,71 @@
+import pytest
+
+from app import dao
+from app.models import Schedule, Score, ScoreType, User, UserRoleEnum
+from tests.conftest import login
+
+
+@pytest.fixture
+def gradebook_url(app, client):
+    schedule = Schedule.query.first()
+    login(client, schedule.user_id)
+    return f'/gradebook/{schedule.class_id}/{schedule.subject_id}/1', schedule
+
+
+@pytest.mark.parametrize('payload', [{"changes": "abc"}, {"changes": [1, 2]}, ["abc"], {"changes": None}])
+def test_gradebook_rejects_malformed_payload(client, gradebook_url, payload):
+    url, _ = gradebook_url
+    response = client.post(url, json=payload)
+    assert response.status_code == 400
+    assert response.get_json()["errors"]
+
+
+@pytest.mark.parametrize('value', ['nan', 'inf', '-inf', '11', '-1', 'abc'])
+def test_gradebook_rejects_invalid_scores(client, gradebook_url, value):
+    url, schedule = gradebook_url
+    student = User.query.filter_by(user_role=UserRoleEnum.STUDENT, class_id=schedule.class_id).first()
+    before = Score.query.count()
+    response = client.post(url, json={"changes": [{"student_id": student.id, "type_id": 1, "score": value}]})
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["message"]
+    assert Score.query.count() == before
+
+
+def _class_and_subject():
+    schedule = Schedule.query.first()
+    student = User.query.filter_by(user_role=UserRoleEnum.STUDENT, class_id=schedule.class_id).first()
+    return schedule, student
+
+
+def test_import_scores_accepts_numeric_cells(app):
+    schedule, student = _class_and_subject()
+    Score.query.filter_by(user_id=student.id, subject_id=schedule.subject_id, semester_id=2).delete()
+    # XLSX trả về số thực cho ô số
+    rows = [{"student_id": float(student.id), "type_id": 1.0, "score": 7.5}]
+    result = dao.import_scores(rows, class_id=schedule.class_id, subject_id=schedule.subject_id, semester_id=2)
+    assert result == {"inserted": 1, "errors": []}
+
+
+@pytest.mark.parametrize('value', ['nan', 'inf', float('nan')])
+def test_import_scores_rejects_non_finite(app, value):
+    schedule, student = _class_and_subject()
+    rows = [{"student_id": str(student.id), "type": "Điểm thi", "score": value}]
+    result = dao.import_scores(rows, class_id=schedule.class_id, subject_id=schedule.subject_id, semester_id=1)
+    assert result["inserted"] == 0
+    assert result["errors"] == [{"row": 2, "message": "Điểm không hợp lệ."}]
+
+
+def test_gradebook_rejects_repeated_score_id(client, gradebook_url):
+    url, schedule = gradebook_url
+    exam_type = ScoreType.query.filter_by(name='Điểm thi').first()
+    exam = Score.query.join(User, User.id == Score.user_id).filter(
+        User.class_id == schedule.class_id, Score.subject_id == schedule.subject_id, Score.semester_id == 1,
+        Score.type_id == exam_type.id).first()
+    deletion = {"student_id": exam.user_id, "type_id": exam_type.id, "score_id": exam.id, "score": ""}
+    insertion = {"student_id": exam.user_id, "type_id": exam_type.id, "score": "8"}
+
+    # Xoá cùng một điểm thi hai lần không được trả lại hai lần nhập
+    response = client.post(url, json={"changes": [deletion, deletion, insertion, insertion]})
+    assert response.status_code == 400
+    assert Score.query.filter_by(user_id=exam.user_id, subject_id=schedule.subject_id, semester_id=1,
+                                 type_id=exam_type.id).count() == 1
@@ -0,0 +1,32 @@
+import pytest
+
+from app import db, dao
+from app.models import Score, Semester
+
+
+def test_semester_id_from_url(app):
+    results = dao.compute_semester_results('1', class_id='1')
+    assert results == dao.compute_semester_results(1, class_id=1)
+    assert results and results[0]["rank"] == 1
+
+
+@pytest.mark.parametrize('semester_id', [1, 2])
+def test_gpa_matches_transcript(app, semester_id):
+    semester = db.session.get(Semester, semester_id)
+    results = dao.compute_semester_results(semester_id)
+    assert results
+    for result in results:
+        _, semester_averages = dao.get_transcript(result["user_id"])
+        assert semester_averages.get(semester.name) == result["gpa"]
+
+
+def test_gpa_follows_score_changes(app):
+    # Sửa một điểm phải tính lại điểm trung bình học kì đã lưu, khớp với cách tính của bảng điểm
+    score = Score.query.filter_by(semester_id=1).first()
+    score.score = 10 - score.score
+    db.session.commit()
+    dao.scores_changed([(score.user_id, score.subject_id, score.semester_id)])
+
+    gpa = {r["user_id"]: r["gpa"] for r in dao.compute_semester_results(1)}[score.user_id]
+    scores_by_semester = dao.get_scores_by_semester(dao.get_scores(score.user_id))
+    assert gpa == dao.calculate_semester_averages(scores_by_semester)[score.semester.name]
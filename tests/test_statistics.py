@@ -0,0 +1,34 @@
+from app import dao
+from tests.conftest import count_queries, login
+
+STATS_URL = '/admin/mystatsview/'
+
+# Trang thống kê: danh sách môn, học kì và nhiều nhất một truy vấn thống kê
+STATS_QUERY_BUDGET = 4
+
+
+def test_statistics_page_query_budget(app, client):
+    login(client, 1)
+    count, _ = count_queries(client, STATS_URL, 'post', data={'subject_id': '1', 'semester_id': '1'})
+    assert count <= STATS_QUERY_BUDGET
+
+
+def test_statistics_without_selection(app, client):
+    login(client, 1)
+    assert client.post(STATS_URL, data={}).status_code == 200
+    assert dao.get_statistics(None, '1') == []
+    assert dao.get_statistics('abc', '1') == []
+
+
+def test_statistics_cache_expires(app):
+    dao.get_statistics(1, 1)
+    expires, statistics = dao._statistics_cache[(1, 1)]
+    # Cache hết hạn (giống worker khác sau STATISTICS_CACHE_TTL) thì tính lại
+    dao._statistics_cache[(1, 1)] = (0, [])
+    assert dao.get_statistics('1', '1') == statistics
+
+
+def test_rebuild_score_summary_clears_statistics(app):
+    dao.get_statistics(1, 1)
+    dao.rebuild_score_summary()
+    assert (1, 1) not in dao._statistics_cache
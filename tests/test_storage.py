@@ -0,0 +1,19 @@
+import io
+
+from PIL import Image
+
+from app import storage
+
+
+def test_local_storage_writes_png_thumbnails(tmp_path):
+    original = io.BytesIO()
+    Image.new('CMYK', (600, 400)).save(original, format='JPEG')
+
+    urls = storage.LocalStorage(str(tmp_path), '/static/avatars').save('avatar-1', original.getvalue(),
+                                                                       storage.AVATAR_SIZES)
+
+    for name, size in storage.AVATAR_SIZES.items():
+        assert urls[name] == f'/static/avatars/avatar-1_{name}.png'
+        with Image.open(tmp_path / f'avatar-1_{name}.png') as image:
+            assert image.format == 'PNG'
+            assert max(image.size) == size
@@ -0,0 +1,55 @@
+from app import db, dao
+from app.models import Score, User, UserRoleEnum
+from tests.conftest import login
+
+
+def _count(transcript):
+    scores_by_semester, _ = transcript
+    return sum(len(scores) for subjects in scores_by_semester.values() for types in subjects.values()
+               for name, scores in types.items() if name != 'Điểm trung bình')
+
+
+def test_transcript_follows_scores_written_by_another_worker(app):
+    student = User.query.filter_by(user_role=UserRoleEnum.STUDENT).first()
+    before = _count(dao.get_transcript(student.id))
+
+    # Worker khác ghi điểm: không gọi scores_changed ở worker này
+    score = Score.query.filter_by(user_id=student.id).first()
+    db.session.add(Score(user_id=student.id, subject_id=score.subject_id, semester_id=score.semester_id,
+                         type_id=score.type_id, score=9))
+    db.session.commit()
+
+    assert _count(dao.get_transcript(student.id)) == before + 1
+
+
+def test_student_scores_page_uses_route_version(client):
+    with client.application.app_context():
+        student = User.query.filter_by(user_role=UserRoleEnum.STUDENT).order_by(User.id.desc()).first()
+    login(client, student.id)
+    first = client.get('/student_scores')
+    assert first.status_code == 200
+    assert client.get('/student_scores', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+
+def test_etag_is_the_same_on_a_fresh_worker(client):
+    with client.application.app_context():
+        student = User.query.filter_by(user_role=UserRoleEnum.STUDENT).order_by(User.id.desc()).first()
+    login(client, student.id)
+    etag = client.get('/api/student_scores').headers['ETag']
+
+    # Worker mới khởi động: chưa có cache menu, cache trang hay bảng điểm nào
+    dao.clear_nav_cache()
+    dao.clear_transcript_cache()
+    dao._rendered_cache.clear()
+    assert client.get('/api/student_scores').headers['ETag'] == etag
+
+
+def test_scores_version_changes_within_the_same_second(app):
+    score = Score.query.first()
+    versions = []
+    for value in (9, 8):
+        score.score = value
+        db.session.commit()
+        versions.append(dao.get_scores_version(user_id=score.user_id))
+    # Cùng số dòng, sửa cách nhau chưa tới một giây
+    assert versions[0] != versions[1]